@@ -1,4 +1,5 @@
 # Example package with a console entry point
 
 def main():
-    print "Hello World"
+    from pyadde.adde import main as adde_main
+    return adde_main()
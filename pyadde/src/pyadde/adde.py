@@ -9,12 +9,22 @@ Copyright (c) 2014 University of Wisconsin SSEC. All rights reserved.
 """
 
 import os, sys
+import queue
 import logging
 import ctypes as C
+import mmap
 import socket
 import struct
 import unittest
-from collections import namedtuple
+import threading
+import time
+import zlib
+from collections import namedtuple, OrderedDict
+
+import numpy as np
+
+from pyadde.pool import DEFAULT_POOL, DEFAULT_RESOLVER, BufferPool, ConnectionPool
+from pyadde.metrics import RequestTiming, TimedSocket, clock
 
 CARD_SIZE = 80
 
@@ -96,18 +106,45 @@ TABLE_BPE_TO_TYPE = { 1: C.c_int8,
                       4: C.c_int32
 }
 
+def _image_dtype(bytes_per_element, byteorder='>'):
+    "NumPy dtype for image elements of a given size, big-endian (network order) by default"
+    return np.dtype(TABLE_BPE_TO_TYPE[bytes_per_element]).newbyteorder(byteorder)
+
+
 def _recv_length_word(sock):
-    total_bytes, = struct.unpack('!l', sock.recv(4))
+    total_bytes, = struct.unpack('!l', bytes(_recv_all(sock, 4)))
     return total_bytes
 
 
+class IncompleteTransfer(IOError):
+    """
+    the connection ended or failed before a receive completed
+    received bytes had been placed at the start of buffer, the buffer given to _recv_all
+    """
+    received = 0
+    buffer = None
+
+    def __init__(self, message, received=0, buffer=None):
+        super(IncompleteTransfer, self).__init__(message)
+        self.received = received
+        self.buffer = buffer
+
+
+class ImageChanged(ValueError):
+    "a resumed transfer was answered with a different image than the one partly received"
+
+
 def _recv_all(sock, toread, buffer=None):
     # ref http://stackoverflow.com/questions/15962119/using-bytearray-with-socket-recv-into
     LOG.debug('about to recv %d bytes' % toread)
     buf = buffer if (buffer is not None) else bytearray(toread)
     view = memoryview(buf)
+    total = toread
     while toread>0:
-        n_got = sock.recv_into(view, toread)
+        try:
+            n_got = sock.recv_into(view, toread)
+        except socket.error as err:
+            raise IncompleteTransfer('expecting %d more bytes: %s' % (toread, err), total - toread, buffer)
         if n_got==0:
             LOG.error('socket returned no data but waiting for %d more' % toread)
             break
@@ -115,10 +152,64 @@ def _recv_all(sock, toread, buffer=None):
         view = view[n_got:]
         toread -= n_got
     if toread!=0:
-        raise IOError('expecting %d more bytes' % toread)
+        raise IncompleteTransfer('expecting %d more bytes' % toread, total - toread, buffer)
     return buf
 
 
+# preamble port word selecting the reply compression, as McIDAS clients send it; LZW 'compress' replies
+# (port word 503) are left out, there being no LZW decoder in the standard library
+COMPRESSION_PORT_WORDS = {None: 1, 'gzip': 112}
+
+# compressed bytes read per socket recv, and the most inflated bytes handed back per recv_into
+COMPRESSED_CHUNK = 1 << 16
+INFLATE_CHUNK = 1 << 20
+
+
+class InflatingSocket(object):
+    """
+    read side of a socket carrying a gzip-compressed reply, inflating as it is read
+
+    recv_into() and recv() return inflated bytes, so _recv_all and the receive functions work unchanged
+    and the reply is inflated into its final buffer a chunk at a time, never held compressed in full.
+    """
+    sock = None
+    compressed_bytes = 0
+
+    def __init__(self, sock):
+        self.sock = sock
+        self._inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._pending = b''
+
+    def _inflate(self, nbytes):
+        while True:
+            if self._inflater.eof:
+                # a further gzip member may follow the first
+                leftover = self._inflater.unused_data
+                self._inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                self._pending = leftover + self._pending
+            if not self._pending:
+                self._pending = self.sock.recv(COMPRESSED_CHUNK)
+                self.compressed_bytes += len(self._pending)
+                if not self._pending:
+                    return b''
+            out = self._inflater.decompress(self._pending, nbytes)
+            self._pending = self._inflater.unconsumed_tail
+            if out:
+                return out
+
+    def recv_into(self, buffer, nbytes=0, flags=0):
+        view = memoryview(buffer)
+        out = self._inflate(min(nbytes or len(view), INFLATE_CHUNK))
+        view[:len(out)] = out
+        return len(out)
+
+    def recv(self, bufsize, flags=0):
+        return self._inflate(min(bufsize, INFLATE_CHUNK))
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
 
 class area_header_t(C.Structure):
     """
@@ -179,7 +270,18 @@ class adde_aget_t(C.BigEndianStructure):
     __repr__ = _fields_repr
 
 
-def form_aget(text, host, port, user, project, password, server_inaddr=None, client_inaddr=None):
+def _ascii(text):
+    "byte string for a ctypes character field, from either str or bytes"
+    return text if isinstance(text, bytes) else text.encode('ascii')
+
+
+def _inaddr(address):
+    "inaddr_t from a dotted-quad address string"
+    return inaddr_t.from_buffer_copy(socket.inet_aton(address))
+
+
+def form_aget(text, host, port, user, project, password, server_inaddr=None, client_inaddr=None, resolver=None,
+              service='AGET', compression=None):
     """
     Return a data structure that can be sent to network.
 
@@ -189,31 +291,155 @@ def form_aget(text, host, port, user, project, password, server_inaddr=None, cli
     :param project: project number, integer
     :param password:
     :param text:
-    :return: adde_aget_t structure
+    :param resolver: ResolverCache used when addresses are not given, default is the shared one
+    :param service: ADDE service, AGET or ADIR
+    :param compression: reply compression to ask for, a key of COMPRESSION_PORT_WORDS
+    :return: adde_aget_t structure, extended with the request text when it exceeds 120 characters
 
     """
-    server = server_inaddr if (server_inaddr is not None) else inaddr_t.from_buffer_copy(socket.inet_aton(list(socket.gethostbyaddr(host))[2][0]))
-    client = client_inaddr if (client_inaddr is not None) else inaddr_t.from_buffer_copy(socket.inet_aton(list(socket.gethostbyaddr(socket.gethostname()))[2][0]))
+    resolver = resolver if (resolver is not None) else DEFAULT_RESOLVER
+    server = server_inaddr if (server_inaddr is not None) else _inaddr(resolver.address(host))
+    client = client_inaddr if (client_inaddr is not None) else _inaddr(resolver.local_address())
 
-    req = adde_aget_t()
+    text = _ascii(text)
+    long_text = len(text) > 120
+    req = _aget_long_type(len(text))() if long_text else adde_aget_t()
     req.preamble.version = 1
     req.preamble.server_address = server
-    req.preamble.port = 1 # port FIXME?????
-    req.preamble.service = 'AGET'
+    if compression not in COMPRESSION_PORT_WORDS:
+        raise ValueError('%r compression is not supported, use gzip' % (compression, ))
+    req.preamble.port = COMPRESSION_PORT_WORDS[compression]
+    req.preamble.service = _ascii(service)
 
     req.server_address = server
     req.server_port = port
     req.client_address = client
-    req.user = user.ljust(4,' ')
+    req.user = _ascii(user).ljust(4, b' ')
     req.project = project
-    req.password = password.ljust(12, '\0')
-    req.service = 'AGET'
-    req.input_length = 0 # len(text) FIXME?????
-    req.text = text.ljust(120, ' ')
+    req.password = _ascii(password).ljust(12, b'\0')
+    req.service = _ascii(service)
+    if long_text:
+        # text too long for the fixed field follows the request, its length given in input_length
+        req.input_length = len(text)
+        req.text = b' ' * 120
+        req.long_text = text
+    else:
+        req.input_length = 0 # len(text) FIXME?????
+        req.text = text.ljust(120, b' ')
 
     return req
 
 
+def form_adir(text, host, port, user, project, password, **kwargs):
+    "Return an ADIR image directory request, otherwise as form_aget"
+    return form_aget(text, host, port, user, project, password, service='ADIR', **kwargs)
+
+
+def _aget_long_type(text_length):
+    "adde_aget_t followed by text_length bytes of request text"
+    def build():
+        class adde_aget_long_t(adde_aget_t):
+            _pack_ = 1
+            _fields_ = (('long_text', C.c_char * text_length), )
+        return adde_aget_long_t
+    return LAYOUT_CACHE.get(('aget_request', text_length), build)
+
+
+#
+# request text
+#
+
+# positional token indices in AGET request text, e.g. "EASTL FD -1 EC 45 90 X 480 640 BAND= 1 ..."
+# group, descriptor, position, coordinate type ([AEI][CU]), two coordinates, placeholder, lines, elements
+AGET_POS_POSITION = 2
+AGET_POS_COORD_TYPE = 3
+AGET_POS_LINES = 7
+AGET_POS_ELEMENTS = 8
+
+
+def parse_request_text(text):
+    """
+    split ADDE request text into a list of positional tokens and an OrderedDict of keyword values
+    tokens following a keyword belong to it, e.g. TIME=X X I or BAND= 1
+    """
+    positional = []
+    keywords = OrderedDict()
+    current = None
+    for token in _ascii(text).decode('ascii').split():
+        if '=' in token:
+            current, _, value = token.partition('=')
+            keywords[current] = [value] if value else []
+        elif current is None:
+            positional.append(token)
+        else:
+            keywords[current].append(token)
+    return positional, OrderedDict((k, ' '.join(v)) for (k, v) in keywords.items())
+
+
+def format_request_text(positional, keywords):
+    "inverse of parse_request_text"
+    return ' '.join(list(positional) + ['%s=%s' % kv for kv in keywords.items()])
+
+
+def canonical_request_text(text):
+    """
+    request text normalized so that equivalent requests compare equal: tokens upper-cased,
+    whitespace collapsed, keywords sorted by name
+    """
+    positional, keywords = parse_request_text(text)
+    positional = [p.upper() for p in positional]
+    keywords = OrderedDict(sorted((k.upper(), v.upper()) for (k, v) in keywords.items()))
+    return format_request_text(positional, keywords)
+
+
+def aget_placement(text):
+    """
+    return (coordinate type, coordinate 1, coordinate 2, lines, elements) from AGET request text
+    """
+    positional, _ = parse_request_text(text)
+    if len(positional) <= AGET_POS_ELEMENTS:
+        raise ValueError('AGET request does not specify placement and size: %r' % text)
+    coord_type = positional[AGET_POS_COORD_TYPE].upper()
+    if len(coord_type) != 2 or coord_type[0] not in 'AEI' or coord_type[1] not in 'CU':
+        raise ValueError('unrecognized AGET coordinate type %r' % coord_type)
+    return (coord_type, positional[AGET_POS_COORD_TYPE + 1], positional[AGET_POS_COORD_TYPE + 2],
+            int(positional[AGET_POS_LINES]), int(positional[AGET_POS_ELEMENTS]))
+
+
+def with_aget_position(text, position):
+    """
+    rewrite AGET request text for another dataset position, e.g. -1 for the image before the most recent
+    """
+    positional, keywords = parse_request_text(text)
+    if len(positional) <= AGET_POS_POSITION:
+        raise ValueError('AGET request does not specify a position: %r' % text)
+    positional[AGET_POS_POSITION] = str(position)
+    return format_request_text(positional, keywords)
+
+
+def with_aget_time(text, image_time, day=None):
+    """
+    rewrite AGET request text to select the image at a time, e.g. '12:15:00', and optionally a day, e.g. 2014164
+    """
+    positional, keywords = parse_request_text(text)
+    keywords['TIME'] = '%s %s I' % (image_time, image_time)
+    if day is not None:
+        keywords['DAY'] = str(day)
+    return format_request_text(positional, keywords)
+
+
+def with_aget_placement(text, coord_type, coord1, coord2, lines, elements):
+    """
+    rewrite AGET request text to cover a different area, keeping dataset, position and keywords
+    """
+    positional, keywords = parse_request_text(text)
+    positional = positional + ['X'] * (AGET_POS_ELEMENTS + 1 - len(positional))
+    positional[AGET_POS_COORD_TYPE:AGET_POS_COORD_TYPE + 3] = [coord_type, str(coord1), str(coord2)]
+    positional[AGET_POS_LINES] = str(lines)
+    positional[AGET_POS_ELEMENTS] = str(elements)
+    return format_request_text(positional, keywords)
+
+
 block_loc_t = namedtuple('block_loc_t', ('offset', 'length'))
 NOWHERE = block_loc_t(0, 0)
 
@@ -231,58 +457,658 @@ def _find_blocks(hdr):
     return aux, cal, nav
 
 
+def header_bands(hdr):
+    "band numbers present in an image, in ascending order, from the header's two band maps"
+    bits = (hdr.spectral_band_map_1_32 & 0xffffffff) | ((hdr.spectral_band_map_33_64 & 0xffffffff) << 32)
+    return [b + 1 for b in range(64) if bits & (1 << b)]
+
+
+def _line_bytes(hdr):
+    "bytes per image line in the data block: line prefix, then elements * bands values"
+    return hdr.line_prefix_length + hdr.elements * max(hdr.spectral_band_count, 1) * hdr.bytes_per_element
+
 
-def recv_aget(sock):
+def line_prefix_dtype(hdr, byteorder='>'):
     """
-    create a structure holding the AGET outcome
-    this type should then be mapped over received ADDE data
+    NumPy structured dtype for the line prefixes of an image, as laid out by its header
+    fields are validity (when the header's validity_code is nonzero), then doc, cal and band sections
+    as byte arrays, those present; the itemsize is a whole line, so an array of them strides over the data block
+    """
+    names, formats, offsets = [], [], []
+    offset = 0
+    if hdr.validity_code != 0:
+        names.append('validity')
+        formats.append(np.dtype(np.int32).newbyteorder(byteorder))
+        offsets.append(0)
+        offset = 4
+    for name, length in (('doc', hdr.prefix_doc_length), ('cal', hdr.prefix_cal_length),
+                         ('band', hdr.prefix_band_length)):
+        if length > 0:
+            names.append(name)
+            formats.append((np.uint8, (length, )))
+            offsets.append(offset)
+            offset += length
+    if offset > hdr.line_prefix_length:
+        raise ValueError('line prefix sections of %d bytes exceed the %d byte prefix' % (offset, hdr.line_prefix_length))
+    return np.dtype(dict(names=names, formats=formats, offsets=offsets, itemsize=_line_bytes(hdr)))
+
+
+
+def _text_words(fields):
+    "zero-based indices of the 32-bit words holding characters in a ctypes _fields_ sequence"
+    words = []
+    offset = 0
+    for name, typ in fields:
+        size = C.sizeof(typ)
+        if issubclass(typ, C.Array) and typ._type_ is C.c_char:
+            words.extend(range(offset // 4, (offset + size) // 4))
+        offset += size
+    return tuple(words)
+
+
+# header words that are text and keep their byte order: memo, source_type, cal_type, and the
+# original_source_type and units words (57 and 58), which hold text though declared as integers
+HEADER_TEXT_WORDS = _text_words(AREA_HEADER_FIELDS) + (56, 57)
+
+# zero-based nav block words holding text rather than integers, by nav type; others keep only the type word
+# GVAR follows the word layout of flip_nav in the reference nomc.py
+NAV_TEXT_WORDS = {
+    'GVAR': (slice(0, 2), slice(127, 129), slice(255, 257), slice(383, 385), slice(511, 513), slice(639, None)),
+}
+
+
+def _block_text_mask(raw, nwords, nav=False):
+    "boolean mask of the words in a nav or cal block that are text and must not be swapped"
+    mask = np.zeros(nwords, dtype=bool)
+    kind = bytes(raw[:4])
+    if nav:
+        for words in NAV_TEXT_WORDS.get(kind.decode('ascii', 'replace'), (slice(0, 1), )):
+            mask[words] = True
+    elif kind.rstrip(b' \0').isalnum():
+        # a cal block may lead with its type as text, blank or NUL padded like b'RAW '
+        mask[0] = True
+    return mask
+
+
+def _swap_words(buf, offset, nwords, text=None):
+    "byte-swap nwords 32-bit words of a writable buffer in place, except those flagged in the boolean mask text"
+    words = np.frombuffer(buf, dtype=np.uint32, count=nwords, offset=offset)
+    if text is None or not text.any():
+        words.byteswap(inplace=True)
+    else:
+        keep = ~text
+        words[keep] = words[keep].byteswap()
+
+
+def _swap_block(block, nav=False):
+    "copy of a nav or cal block with its integer words byte-swapped, in either direction"
+    raw = bytearray(block)
+    n = len(raw) // 4
+    _swap_words(raw, 0, n, _block_text_mask(raw, n, nav))
+    return bytes(raw)
+
+
+def _swap_payload(blob, hdr, image=True):
+    "byte-swap a payload or AREA file in place, given its header as a structure in the blob's byte order"
+    aux, cal, nav = _find_blocks(hdr)
+    for loc, is_nav in ((nav, True), (cal, False)):
+        if loc.length >= 4:
+            n = loc.length // 4
+            mask = _block_text_mask(memoryview(blob)[loc.offset:loc.offset + 4], n, is_nav)
+            _swap_words(blob, loc.offset, n, mask)
+    line_bytes = _line_bytes(hdr)
+    if image and hdr.bytes_per_element > 1:
+        per_line = hdr.elements * max(hdr.spectral_band_count, 1)
+        data = np.ndarray((hdr.lines, per_line), dtype=_image_dtype(hdr.bytes_per_element, '='), buffer=blob,
+                          offset=hdr.data_block_offset + hdr.line_prefix_length,
+                          strides=(line_bytes, hdr.bytes_per_element))
+        data.byteswap(inplace=True)
+    if hdr.line_prefix_length >= 4 and hdr.validity_code != 0:
+        # each prefix leads with the validity code word
+        codes = np.ndarray((hdr.lines, ), dtype=np.uint32, buffer=blob, offset=hdr.data_block_offset,
+                           strides=(line_bytes, ))
+        codes.byteswap(inplace=True)
+    text = np.zeros(64, dtype=bool)
+    text[list(HEADER_TEXT_WORDS)] = True
+    _swap_words(blob, 0, 64, text)
+
+
+def payload_to_native(blob, image=True):
+    """
+    convert an AGET payload in a writable buffer to native-order AREA layout in place,
+    one vectorized pass per block instead of a flip per word
+
+    Header, nav and cal integers are swapped, their text words left as they are; image elements
+    are swapped according to their size, and line prefix validity codes as integers. Aux blocks, the rest of
+    the line prefixes and comment cards are left as received.
+    :param image: also swap the data block; False if it is already native, e.g. after to_native()
+    :return: area_header_t mapped over blob
+    """
+    if sys.byteorder != 'big':
+        _swap_payload(blob, adde_header_t.from_buffer_copy(memoryview(blob)[:256]), image)
+    return area_header_t.from_buffer(blob)
+
+
+def native_to_payload(blob):
+    """
+    inverse of payload_to_native: convert a native-order AREA layout in a writable buffer to network order
+    :return: adde_header_t mapped over blob
+    """
+    if sys.byteorder != 'big':
+        _swap_payload(blob, area_header_t.from_buffer_copy(memoryview(blob)[:256]))
+    return adde_header_t.from_buffer(blob)
+
+
+class LRUCache(object):
+    """
+    bounded, thread-safe least-recently-used cache of built values, e.g. result structure types or lookup tables
+
+    A value is built at most once per key while it stays cached; concurrent misses on one key may each build it,
+    the last build being kept.
+    """
+    maxsize = None
+    hits = 0
+    misses = 0
+
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, build):
+        """
+        return the value cached under key, calling build() to create it on a miss
+        """
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries[key] = self._entries.pop(key)  # most recently used goes last
+                self.hits += 1
+                return value
+            self.misses += 1
+        value = build()
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    @property
+    def size(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return dict(size=self.size, maxsize=self.maxsize, hits=self.hits, misses=self.misses,
+                    hit_rate=self.hit_rate)
+
+
+# result types for AGET and directory replies: building a ctypes Structure with hundreds of fields is costly,
+# and every new class lives as long as the interpreter unless released, so repeated fetches of one product share one
+LAYOUT_CACHE = LRUCache()
+
+
+class adde_aget_result_t(C.BigEndianStructure):
+    """
+    base of the AGET result structures built by map_aget, adding NumPy access to the image
+    """
+    _pack_ = 1
+    # set once to_native() has swapped the image in place; the ctypes 'image' field is then stale
+    _image_native = False
+
+    @property
+    def band_count(self):
+        return max(self.spectral_band_count, 1)
+
+    @property
+    def image_array(self):
+        """
+        lines x elements ndarray sharing memory with the received buffer, no copy made;
+        lines x elements x bands for multi-band images, which ADDE interleaves by pixel.
+        Line prefixes are skipped over by the line stride.
+        """
+        dtype = _image_dtype(self.bytes_per_element, '=' if self._image_native else '>')
+        bpe = self.bytes_per_element
+        shape, strides = (self.lines, self.elements), (_line_bytes(self), bpe * self.band_count)
+        if self.band_count > 1:
+            shape, strides = shape + (self.band_count, ), strides + (bpe, )
+        return np.ndarray(shape, dtype=dtype, buffer=self, offset=type(self).image.offset + self.line_prefix_length,
+                          strides=strides)
+
+    @property
+    def line_prefixes(self):
+        """
+        structured array of the line prefixes, one row per line, sharing memory with the received buffer;
+        see line_prefix_dtype for the fields. None if the image has no line prefixes
+        """
+        if self.line_prefix_length == 0:
+            return None
+        return np.ndarray((self.lines, ), dtype=line_prefix_dtype(self), buffer=self, offset=type(self).image.offset)
+
+    @property
+    def band_numbers(self):
+        "band numbers in the order they are interleaved, from the band maps, else 1..band_count"
+        bands = header_bands(self)
+        return bands if len(bands) == self.band_count else list(range(1, self.band_count + 1))
+
+    def band_array(self, band):
+        """
+        lines x elements strided view of one band of the image, no copy made
+        :param band: band number, see band_numbers
+        """
+        bands = self.band_numbers
+        if band not in bands:
+            raise KeyError('band %r is not in this image, which has bands %s' % (band, bands))
+        image = self.image_array
+        return image if self.band_count == 1 else image[:, :, bands.index(band)]
+
+    @property
+    def band_arrays(self):
+        "OrderedDict of band number to band_array() view"
+        return OrderedDict((band, self.band_array(band)) for band in self.band_numbers)
+
+    def to_native(self):
+        """
+        byte-swap the image in place to native order and return the native-order ndarray view
+        after this the ctypes 'image' field no longer reads correctly; use image_array
+        """
+        arr = self.image_array
+        if not self._image_native and arr.dtype.byteorder not in ('=', '|'):
+            arr.byteswap(inplace=True)
+            self._image_native = True
+        return self.image_array
+
+
+def map_aget(blob):
+    """
+    create a structure holding the AGET outcome and map it over blob,
+    a complete AGET payload (everything following the length word)
     http://www.ssec.wisc.edu/mcidas/doc/prog_man/current/servers-5.html#25171
     """
-    total_bytes = _recv_length_word(sock)
-    blob = _recv_all(sock, total_bytes)
+    total_bytes = len(blob)
     view = memoryview(blob)
 
-    # start building a data structure schema for the block of data we just received
-    fields = list(AREA_HEADER_FIELDS)
-
     # copy a chunk of data that we know is the header
     header = adde_header_t.from_buffer_copy(view[:256])
 
-    #comments_field = ('comments', (C.c_char * 80) * header.comment_count)
     aux, cal, nav = _find_blocks(header)
 
-    if nav.length > 0:
-        # FIXME for now just put in a block of characters - eventually this is a separate structure
-        fields.append(('_nav_raw', C.c_byte * nav.length))
-
-    if cal.length > 0:
-        # FIXME for now a placeholder for a set of cal fields
-        fields.append(('_cal_raw', C.c_byte * cal.length))
-
     # FIXME add aux handling - for now just error out if somebody slips us some aux or cal
     assert(aux.length == 0)
 
     data_block_length = total_bytes - header.data_block_offset - (header.comment_count * CARD_SIZE)
-    element_typ = TABLE_BPE_TO_TYPE[header.bytes_per_element]
-    assert((data_block_length % header.bytes_per_element)==0)
-    total_elements = data_block_length / header.bytes_per_element
-    assert(total_elements == header.lines * header.elements)
-    fields.append( ('image', (element_typ * header.elements) * header.lines) )
+    bands = max(header.spectral_band_count, 1)
+    assert(data_block_length == header.lines * _line_bytes(header))
+
+    cls = aget_result_type(header.lines, header.elements, header.bytes_per_element,
+                           nav.length, cal.length, aux.length, header.comment_count, bands, header.line_prefix_length)
+    return cls.from_buffer(view)
+
+
+def aget_result_type(lines, elements, bytes_per_element, nav_length, cal_length, aux_length, comment_count, bands=1,
+                     prefix_length=0):
+    """
+    return the AGET result structure type for a reply of the given shape, from LAYOUT_CACHE when possible
+    multi-band images are pixel-interleaved, each line of the image field holding elements * bands values;
+    with line prefixes, the image field holds each line's bytes, prefix included
+    """
+    key = ('aget', lines, elements, bytes_per_element, nav_length, cal_length, aux_length, comment_count, bands,
+           prefix_length)
+
+    def build():
+        # start building a data structure schema for the block of data we just received
+        fields = list(AREA_HEADER_FIELDS)
+
+        if nav_length > 0:
+            # FIXME for now just put in a block of characters - eventually this is a separate structure
+            fields.append(('_nav_raw', C.c_byte * nav_length))
+
+        if cal_length > 0:
+            # FIXME for now a placeholder for a set of cal fields
+            fields.append(('_cal_raw', C.c_byte * cal_length))
+
+        element_typ = TABLE_BPE_TO_TYPE[bytes_per_element]
+        if prefix_length:
+            fields.append( ('image', (C.c_byte * (prefix_length + elements * bands * bytes_per_element)) * lines) )
+        else:
+            fields.append( ('image', (element_typ * (elements * bands)) * lines) )
+
+        comment_field = ('comments', (C.c_char * CARD_SIZE) * comment_count)
+        fields.append(comment_field)
+
+        class _adde_aget_result(adde_aget_result_t):
+            _pack_ = 1
+            _fields_ = fields
+        return _adde_aget_result
+
+    return LAYOUT_CACHE.get(key, build)
+
 
-    comment_field = ('comments', (C.c_char * CARD_SIZE) * header.comment_count)
-    fields.append(comment_field)
+def _mapped_file(path, nbytes):
+    "shared, writable mmap over a file at path created or truncated to nbytes"
+    with open(path, 'w+b') as fp:
+        fp.truncate(nbytes)
+        return mmap.mmap(fp.fileno(), nbytes, access=mmap.ACCESS_WRITE)
 
-    class _adde_aget_result(C.BigEndianStructure):
-        _pack_ = 1
-        _fields_ = fields
 
-    return _adde_aget_result.from_buffer(view)
+def recv_aget(sock, buffers=None, path=None):
+    """
+    receive an AGET reply from sock and return a structure mapped over it, see map_aget
+    :param buffers: optional pool.BufferPool to draw the receive buffer from; see release_aget
+    :param path: receive into a memory-mapped file at path instead of memory, for images larger than RAM;
+        the file holds the payload as sent, a big-endian AREA file readable with area.AreaFile
+    """
+    total_bytes = _recv_length_word(sock)
+    if path is not None:
+        mm = _mapped_file(path, total_bytes)
+        try:
+            _recv_all(sock, total_bytes, mm)
+            return map_aget(mm)
+        except Exception:
+            os.unlink(path)
+            try:
+                mm.close()
+            except BufferError:
+                # the traceback still holds views of the map; it is unmapped once they are released
+                pass
+            raise
+    if buffers is None:
+        blob = _recv_all(sock, total_bytes)
+        return map_aget(blob)
+    buf = buffers.acquire(total_bytes)
+    try:
+        blob = memoryview(buf)[:total_bytes]
+        _recv_all(sock, total_bytes, blob)
+        zult = map_aget(blob)
+    except Exception:
+        buffers.release(buf)
+        raise
+    zult._pool_buffer = buf
+    return zult
+
+
+def _recv_aget_parts(sock, image_buffer):
+    """
+    receive an AGET reply, placing its image data in the buffer returned by image_buffer(header)
+    the image must not carry line prefixes
+    :return: (header, prefix, comments), prefix holding everything ahead of the data block
+    """
+    total_bytes = _recv_length_word(sock)
+    header = adde_header_t.from_buffer_copy(_recv_all(sock, 256))
+    prefix = bytearray(max(header.data_block_offset, 256))
+    prefix[:256] = bytearray(header)
+    _recv_all(sock, len(prefix) - 256, memoryview(prefix)[256:])
+    if header.line_prefix_length != 0:
+        raise ValueError('line prefixes are not supported here')
+    image_bytes = header.lines * header.elements * max(header.spectral_band_count, 1) * header.bytes_per_element
+    comment_bytes = header.comment_count * CARD_SIZE
+    if len(prefix) + image_bytes + comment_bytes != total_bytes:
+        raise ValueError('AGET reply of %d bytes does not match its header' % total_bytes)
+    dest = image_buffer(header)
+    if len(dest) != image_bytes:
+        raise ValueError('AGET reply carries %d image bytes, expected %d' % (image_bytes, len(dest)))
+    _recv_all(sock, image_bytes, dest)
+    comments = _recv_all(sock, comment_bytes)
+    return header, prefix, comments
+
+
+_RELEASE_LOCK = threading.Lock()
+
+
+def release_aget(zult, buffers):
+    """
+    hand the receive buffer behind an AGET result back to the BufferPool it was drawn from
+    zult must not be used afterwards, its memory will be overwritten by a later fetch
+    """
+    with _RELEASE_LOCK:
+        # a result shared by coalesced callers goes back only when the last of them releases it
+        shares = getattr(zult, '_shares', 1) - 1
+        zult._shares = shares
+        buf = getattr(zult, '_pool_buffer', None) if shares <= 0 else None
+        if buf is not None:
+            zult._pool_buffer = None
+    if buf is not None:
+        buffers.release(buf)
 
 
+class _Flight(object):
+    "one in-progress fetch and the callers waiting on it"
+    result = None
+    error = None
+    shares = 1
 
+    def __init__(self):
+        self.done = threading.Event()
 
 
+class RequestCoalescer(object):
+    """
+    single-flight execution: while a fetch for a key is in progress, other callers asking for the
+    same key wait for it and receive the same result object instead of starting a transfer
+    Shared results must be treated as read-only, e.g. no in-place to_native().
+    """
+    transfers = 0
+    coalesced = 0
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fetch):
+        """
+        return fetch(), or the outcome of an identical fetch already in progress
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                flight.shares += 1
+                self.coalesced += 1
+        if leader:
+            try:
+                flight.result = fetch()
+            except Exception as err:
+                flight.error = err
+            with self._lock:
+                del self._flights[key]
+                self.transfers += 1
+                if flight.result is not None:
+                    flight.result._shares = flight.shares
+            flight.done.set()
+        else:
+            flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def stats(self):
+        with self._lock:
+            in_flight = len(self._flights)
+        return dict(transfers=self.transfers, saved=self.coalesced, in_flight=in_flight)
+
+
+class AgetStream(object):
+    """
+    incremental AGET receiver, for overlapping processing with the transfer
 
+    The header, nav and cal blocks are received and exposed on construction. Iterating then
+    yields (first_line, lines) pairs, lines being a big-endian ctypes array of up to
+    lines_per_block image lines, each of elements * bands values for pixel-interleaved bands. Blocks are received into one reused buffer, so peak memory
+    is bounded by the block size; copy a block if it must outlive the next iteration.
+    Comments trail the image and are available once iteration finishes.
+    """
+    total_bytes = None
+    header = None
+    nav = None
+    cal = None
+    comments = None
+    lines_per_block = None
+
+    def __init__(self, sock, lines_per_block=64, callback=None, release=None):
+        """
+        :param sock: socket positioned at the start of an AGET reply
+        :param lines_per_block: number of image lines per yielded block
+        :param callback: optional callable(first_line, lines) invoked for every block
+        :param release: optional callable(sock, complete) invoked when the stream is finished with the socket
+        """
+        self._sock = sock
+        self._callback = callback
+        self._release = release
+        self.lines_per_block = lines_per_block
+        self.total_bytes = _recv_length_word(sock)
+
+        # header first, then whatever lies between it and the data block
+        hdr = adde_header_t.from_buffer_copy(_recv_all(sock, 256))
+        prefix = bytearray(max(hdr.data_block_offset, 256))
+        prefix[:256] = bytearray(hdr)
+        _recv_all(sock, len(prefix) - 256, memoryview(prefix)[256:])
+        self._prefix = prefix
+        self.header = adde_header_t.from_buffer(prefix)
+
+        aux, cal, nav = _find_blocks(self.header)
+        # FIXME add aux handling, as in map_aget
+        assert(aux.length == 0)
+        if nav.length > 0:
+            self.nav = (C.c_byte * nav.length).from_buffer(prefix, nav.offset)
+        if cal.length > 0:
+            self.cal = (C.c_byte * cal.length).from_buffer(prefix, cal.offset)
+
+        h = self.header
+        if h.line_prefix_length != 0:
+            raise ValueError('line prefixes are not supported here')
+        self._element_typ = TABLE_BPE_TO_TYPE[h.bytes_per_element].__ctype_be__
+        self._line_values = h.elements * max(h.spectral_band_count, 1)
+        self._line_bytes = self._line_values * h.bytes_per_element
+        expected = len(prefix) + h.lines * self._line_bytes + h.comment_count * CARD_SIZE
+        if expected != self.total_bytes:
+            raise ValueError('AGET reply of %d bytes does not match header layout of %d bytes' % (self.total_bytes, expected))
+
+    def __iter__(self):
+        h = self.header
+        complete = False
+        try:
+            chunk = bytearray(min(self.lines_per_block, max(h.lines, 1)) * self._line_bytes)
+            line = 0
+            while line < h.lines:
+                n = min(self.lines_per_block, h.lines - line)
+                nbytes = n * self._line_bytes
+                _recv_all(self._sock, nbytes, memoryview(chunk)[:nbytes])
+                lines = ((self._element_typ * self._line_values) * n).from_buffer(chunk)
+                if self._callback is not None:
+                    self._callback(line, lines)
+                yield line, lines
+                line += n
+            cards = _recv_all(self._sock, h.comment_count * CARD_SIZE)
+            self.comments = ((C.c_char * CARD_SIZE) * h.comment_count).from_buffer(cards)
+            complete = True
+        finally:
+            if self._release is not None:
+                self._release(self._sock, complete)
+                self._release = None
+
+    def run(self):
+        "drain the stream, for callers consuming blocks through the callback"
+        for _ in self:
+            pass
+        return self
+
+
+
+
+
+
+
+
+class AgetLoop(object):
+    """
+    iterator over the images of a time loop, fetching the next images while the caller works on the current one
+
+    A background thread fetches up to prefetch images ahead. Receive buffers come from a BufferPool and each
+    result goes back to it once the caller asks for the next, so at most prefetch + 2 buffers exist at a time;
+    copy anything that must outlive its step. Yields (step, result) pairs, step being the position or time
+    the image was requested for; a failed fetch raises at its step.
+    """
+    requests = None
+    prefetch = None
+
+    def __init__(self, session, requests, prefetch=1, buffers=None, timeout=None):
+        """
+        :param session: Session to fetch with; its cache and coalescer are bypassed
+        :param requests: sequence of (step, request text) pairs
+        :param prefetch: number of images fetched ahead of the caller
+        :param buffers: BufferPool for receive buffers, by default the session's or a new one
+        """
+        self.requests = list(requests)
+        self.prefetch = max(1, prefetch)
+        self._session = session
+        self._buffers = buffers or session.buffers or BufferPool()
+        self._timeout = timeout
+        self._ready = queue.Queue(maxsize=self.prefetch)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _fetch_all(self):
+        ses = self._session
+        for step, text in self.requests:
+            if self._stop.is_set():
+                break
+            try:
+                zult = ses._transact(text, lambda s: recv_aget(s, self._buffers), self._timeout)
+                item = (step, zult, None)
+            except Exception as err:
+                item = (step, None, err)
+            # wait for room, giving up if the caller has gone away
+            while not self._stop.is_set():
+                try:
+                    self._ready.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            else:
+                if item[1] is not None:
+                    release_aget(item[1], self._buffers)
+
+    def _drain(self):
+        while True:
+            try:
+                step, zult, err = self._ready.get_nowait()
+            except queue.Empty:
+                return
+            if zult is not None:
+                release_aget(zult, self._buffers)
+
+    def __iter__(self):
+        self._thread = threading.Thread(target=self._fetch_all)
+        self._thread.daemon = True
+        self._thread.start()
+        current = None
+        try:
+            for _ in self.requests:
+                step, zult, err = self._ready.get()
+                if current is not None:
+                    release_aget(current, self._buffers)
+                    current = None
+                if err is not None:
+                    raise err
+                current = zult
+                yield step, zult
+        finally:
+            self._stop.set()
+            if current is not None:
+                release_aget(current, self._buffers)
+            self._drain()
+            self._thread.join()
+            self._drain()
 
 
 #
@@ -298,24 +1124,81 @@ def structure_adde_image_dir_entry(total_bytes):
     comment_count = int((total_bytes - 260) / CARD_SIZE)
     if (total_bytes - 260) % CARD_SIZE != 0:
         raise ValueError('total_bytes %d does not match header + integral comments' % total_bytes)
-    comment_fields = (('comments', (C.c_char * CARD_SIZE) * comment_count), )
-    fields = (('area_number', C.c_int32), ) + area_header_t._fields_ + comment_fields
-    class adde_image_dir_entry(C.BigEndianStructure):
-        _pack_ = 1
-        _fields_ = fields
-    return adde_image_dir_entry
+
+    def build():
+        comment_fields = (('comments', (C.c_char * CARD_SIZE) * comment_count), )
+        fields = (('area_number', C.c_int32), ) + area_header_t._fields_ + comment_fields
+        class adde_image_dir_entry(C.BigEndianStructure):
+            _pack_ = 1
+            _fields_ = fields
+        return adde_image_dir_entry
+
+    return LAYOUT_CACHE.get(('adir', comment_count), build)
+
+def _recv_next_length(sock):
+    "length word of the next directory entry, 0 at the end of the directory or of the connection"
+    first = sock.recv(4)
+    if not first:
+        return 0
+    word = bytearray(4)
+    word[:len(first)] = first
+    _recv_all(sock, 4 - len(first), memoryview(word)[len(first):])
+    total_bytes, = struct.unpack('!l', bytes(word))
+    return total_bytes
+
+
+def iter_adde_image_dir(sock):
+    """
+    receive an ADDE image directory from a socket, yielding one entry structure per image as it arrives
+    each entry is preceded by its length word; a zero length word ends the directory
+    """
+    total_bytes = _recv_next_length(sock)
+    while total_bytes > 0:
+        cls = structure_adde_image_dir_entry(total_bytes)
+        yield cls.from_buffer(_recv_all(sock, total_bytes))
+        total_bytes = _recv_next_length(sock)
+
 
 def recv_adde_image_dir(sock):
     """
-    receive an ADDE image directory from a socket
+    receive an ADDE image directory from a socket, returning a list of entry structures
     """
-    # receive total_bytes and convert to native word order
-    # FIXME: how do we know when the directory is done sending?
-    total_bytes, = _recv_length_word(sock)
-    cls = structure_adde_image_dir_entry(total_bytes)
-    bfr = bytes(sock.recv(total_bytes))
-    return cls.from_buffer(bfr)
-    
+    return list(iter_adde_image_dir(sock))
+
+
+def _fields_dtype(fields, byteorder='>'):
+    "NumPy dtype equivalent to a ctypes _fields_ sequence of integers, integer arrays and character arrays"
+    descr = []
+    for name, typ in fields:
+        shape = ()
+        if issubclass(typ, C.Array) and typ._type_ is not C.c_char:
+            shape, typ = (typ._length_, ), typ._type_
+        if issubclass(typ, C.Array):
+            descr.append((name, 'S%d' % typ._length_))
+        else:
+            descr.append((name, np.dtype(typ).newbyteorder(byteorder), shape))
+    return np.dtype(descr)
+
+
+# one row of an image directory table: the area number and the 64-word area header
+IMAGE_DIR_DTYPE = _fields_dtype((('area_number', C.c_int32), ) + AREA_HEADER_FIELDS)
+
+
+def recv_adde_image_dir_table(sock):
+    """
+    receive an ADDE image directory from a socket as a NumPy structured array, one row per image
+    with columns area_number and AREA_HEADER_FIELDS; comment cards are not kept
+    """
+    row = IMAGE_DIR_DTYPE.itemsize
+    rows = bytearray()
+    total_bytes = _recv_next_length(sock)
+    while total_bytes > 0:
+        if total_bytes < row:
+            raise ValueError('directory entry of %d bytes is shorter than a header' % total_bytes)
+        entry = _recv_all(sock, total_bytes)
+        rows += entry[:row]
+        total_bytes = _recv_next_length(sock)
+    return np.frombuffer(rows, dtype=IMAGE_DIR_DTYPE)
     
 
 
@@ -323,45 +1206,375 @@ def recv_adde_image_dir(sock):
 class Session(object):
     """
     ADDE Session convenience abstraction, holding credentials and cached state
+
+    Sessions share a ConnectionPool and ResolverCache (pyadde.pool) unless given their own,
+    so repeated requests to the same server skip name resolution and, where possible, connect.
+    Given a BufferPool, results are received into pooled buffers; hand them back with release().
+    Given a cache.AgetCache, aget() serves repeated requests from disk instead of the network.
+    Given a RequestCoalescer, which may be shared between sessions, concurrent identical aget()
+    calls share one transfer and one result.
+    Given an instrument, e.g. a metrics.TimingAggregator, each transfer reports its phase timings to it.
+    With compression='gzip', replies are sent compressed and inflated as they are received.
     """
     host = None
     user = None
     port = None
     project = None
     password = None
+    pool = None
+    resolver = None
+    buffers = None
+    cache = None
+    coalescer = None
+    instrument = None
+    compression = None
     # _sock = None
     _server_inaddr = None
     _client_inaddr = None
 
     def _connect(self, timeout=None):
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect((self.host, self.port))
-        s.settimeout(timeout)
-        return s
+        return self.pool.acquire(self.host, self.port, timeout)
 
+    def _inaddrs(self):
+        "server and client addresses, re-resolved through the resolver cache once their TTL lapses"
+        self._server_inaddr = _inaddr(self.resolver.address(self.host))
+        self._client_inaddr = _inaddr(self.resolver.local_address())
+        return self._server_inaddr, self._client_inaddr
 
-    def __init__(self, host, port, user, project, password):
+    def __init__(self, host, port, user, project, password, pool=None, resolver=None, buffers=None, cache=None,
+                 coalescer=None, instrument=None, compression=None):
         self.host = host
         self.port = port
         self.user = user
         self.project = project
         self.password = password
-        self._server_inaddr = inaddr_t.from_buffer_copy(socket.inet_aton(list(socket.gethostbyaddr(host))[2][0]))
-        self._client_inaddr = inaddr_t.from_buffer_copy(socket.inet_aton(list(socket.gethostbyaddr(socket.gethostname()))[2][0]))
-
-
-    def aget(self, request_string, timeout=None):
-
+        self.pool = pool if (pool is not None) else DEFAULT_POOL
+        self.resolver = resolver if (resolver is not None) else DEFAULT_RESOLVER
+        self.buffers = buffers
+        self.cache = cache
+        self.coalescer = coalescer
+        self.instrument = instrument
+        if compression not in COMPRESSION_PORT_WORDS:
+            raise ValueError('%r compression is not supported, use gzip' % (compression, ))
+        self.compression = compression
+        self._inaddrs()
+
+
+    def _reader(self, sock):
+        "what the receive functions read a reply from: the socket, or an inflating wrapper"
+        return InflatingSocket(sock) if self.compression == 'gzip' else sock
+
+    def _transact(self, request_string, receive, timeout=None, service='AGET'):
+        """
+        send an AGET (or other service) request and return receive(sock) applied to the connection
+        """
+        if self.instrument is not None:
+            return self._transact_timed(request_string, receive, timeout, service)
+        server, client = self._inaddrs()
         bfr = form_aget(request_string, self.host, self.port, self.user, self.project, self.password,
-                        server_inaddr=self._server_inaddr, client_inaddr=self._client_inaddr)
+                        server_inaddr=server, client_inaddr=client, service=service,
+                        compression=self.compression)
         LOG.debug(repr(bfr))            
+        s, _, zult = self._exchange(bfr, receive, timeout)
+        self.pool.release(s, self.host, self.port)
+        return zult
+
+    def _exchange(self, bfr, receive, timeout=None, timing=None):
+        """
+        send request bfr on a pooled connection and receive the reply through a metrics.TimedSocket
+        A connection from the pool's idle set that fails before any reply arrives was most likely closed by
+        the server while idle, so the request is sent once more on a new connection. Failed sockets are discarded.
+        :param timing: RequestTiming to note the connect time, reply bytes and times in, if any
+        :return: (socket, TimedSocket, receive's result)
+        """
+        mark = clock()
         s = self._connect(timeout)
-        # bfr = open('/tmp/nomc.bin', 'rb').read()
-        s.send(bfr)
-        zult = recv_aget(s)
-        s.close()
+        for retry in (True, False):
+            if timing is not None:
+                timing.connect = (timing.connect or 0.0) + clock() - mark
+            timed = TimedSocket(self._reader(s))
+            sent = None
+            try:
+                s.sendall(bfr)
+                sent = clock()
+                return s, timed, receive(timed)
+            except Exception as err:
+                self.pool.discard(s)
+                if not (retry and isinstance(err, socket.error) and not isinstance(err, socket.timeout)
+                        and not timed.nbytes and self.pool.was_reused(s)):
+                    raise
+                LOG.info('pooled connection to %s:%d failed before replying (%s), retrying on a new one' % (
+                    self.host, self.port, err))
+            finally:
+                if timing is not None:
+                    timing.nbytes = timed.nbytes
+                    if timed.first is not None:
+                        timing.ttfb = timed.first - sent
+                        timing.transfer = timed.last - timed.first
+            mark = clock()
+            s = self.pool.acquire(self.host, self.port, timeout, fresh=True)
+
+    def _transact_timed(self, request_string, receive, timeout=None, service='AGET'):
+        "_transact, reporting a metrics.RequestTiming to the instrument"
+        timing = RequestTiming(service, request_string, self.host, self.port)
+        start = mark = clock()
+        try:
+            server, client = self._inaddrs()
+            timing.resolve = clock() - mark
+            bfr = form_aget(request_string, self.host, self.port, self.user, self.project, self.password,
+                            server_inaddr=server, client_inaddr=client, service=service,
+                            compression=self.compression)
+            s, timed, zult = self._exchange(bfr, receive, timeout, timing)
+            timing.build = clock() - timed.last
+            self.pool.release(s, self.host, self.port)
+            return zult
+        except Exception as err:
+            timing.error = err
+            raise
+        finally:
+            timing.total = clock() - start
+            self.instrument(timing)
+
+    def _aget(self, request_string, timeout=None):
+        if self.cache is None:
+            return self._transact(request_string, lambda s: recv_aget(s, self.buffers), timeout)
+        zult = self.cache.get(self.host, self.port, request_string)
+        if zult is None:
+            zult = self._transact(request_string, lambda s: recv_aget(s, self.buffers), timeout)
+            self.cache.put(self.host, self.port, request_string, zult)
         return zult
 
+    def aget(self, request_string, timeout=None, path=None):
+        """
+        fetch one AGET request and return its result structure, see map_aget
+        :param path: receive straight into a memory-mapped file at path, see recv_aget
+        """
+        if path is not None:
+            # the caller's file is neither cached nor shared with other callers
+            return self._transact(request_string, lambda s: recv_aget(s, path=path), timeout)
+        if self.coalescer is None:
+            return self._aget(request_string, timeout)
+        key = (self.host, self.port, self.user, self.project, canonical_request_text(request_string))
+        return self.coalescer.do(key, lambda: self._aget(request_string, timeout))
+
+    def adir(self, request_string, timeout=None):
+        """
+        list an image directory, returning a structured array with one row per image, see IMAGE_DIR_DTYPE
+        e.g. rows = ses.adir('EASTL FD ALL'); rows[rows['hhmmss'] >= 120000]
+        """
+        return self._transact(request_string, recv_adde_image_dir_table, timeout, service='ADIR')
+
+    def aget_tiled(self, request_string, tiles=4, timeout=None, max_workers=4):
+        """
+        fetch one AGET as several concurrent requests for bands of lines, assembled in one buffer
+
+        A 1x1 probe at the requested placement first locates the sector in image coordinates;
+        each tile is then requested with IU placement and its rows received directly into the
+        final buffer. The merged header is that of the first tile covering all lines.
+        Center placements follow the McIDAS convention of the center pixel at lines//2, elements//2.
+        :param max_workers: most tiles fetched at once, and so connections open to the server
+        :return: the same result structure as aget()
+        """
+        coord_type, c1, c2, lines, elements = aget_placement(request_string)
+        tiles = max(1, min(tiles, lines))
+
+        probe = self.aget(with_aget_placement(request_string, coord_type, c1, c2, 1, 1), timeout)
+        line_res, element_res = probe.line_res, probe.element_res
+        line_ul, element_ul = probe.line_ul, probe.element_ul
+        prefix_length = max(probe.data_block_offset, 256)
+        comment_count = probe.comment_count
+        line_bytes = elements * probe.band_count * probe.bytes_per_element
+        self.release(probe)
+        if coord_type[1] == 'C':
+            line_ul -= (lines // 2) * line_res
+            element_ul -= (elements // 2) * element_res
+        out = bytearray(prefix_length + lines * line_bytes + comment_count * CARD_SIZE)
+        view = memoryview(out)
+
+        band = (lines + tiles - 1) // tiles
+        parts = [None] * tiles
+        errors = []
+        pending = queue.Queue()
+        for k in range(tiles):
+            if k * band < lines:
+                pending.put(k)
+
+        def fetch(k):
+            first = k * band
+            count = min(band, lines - first)
+            text = with_aget_placement(request_string, 'IU', line_ul + first * line_res, element_ul, count, elements)
+            start = prefix_length + first * line_bytes
+            dest = view[start:start + count * line_bytes]
+            try:
+                parts[k] = self._transact(text, lambda s: _recv_aget_parts(s, lambda hdr: dest), timeout)
+            except Exception as err:
+                LOG.error('tile %d of %d failed: %s' % (k, tiles, err))
+                errors.append(err)
+
+        def work():
+            while not errors:
+                try:
+                    k = pending.get_nowait()
+                except queue.Empty:
+                    return
+                fetch(k)
+
+        workers = [threading.Thread(target=work) for _ in range(max(1, min(max_workers, pending.qsize())))]
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        if errors:
+            raise errors[0]
+
+        header, prefix, comments = parts[0]
+        if len(prefix) != prefix_length or len(comments) != comment_count * CARD_SIZE:
+            raise ValueError('tile layout differs from probe layout')
+        view[:prefix_length] = prefix
+        view[len(out) - len(comments):] = comments
+        merged = adde_header_t.from_buffer(out)
+        merged.lines = lines
+        return map_aget(out)
+
+    def aget_loop(self, request_string, positions=None, times=None, day=None, prefetch=1, timeout=None):
+        """
+        fetch a time loop of images, prefetching the next while the caller processes the current, see AgetLoop
+        e.g. for position, zult in ses.aget_loop(TEST_REQ_STRING, positions=range(-5, 1)): ...
+        :param positions: dataset positions to substitute for the request's position, in order
+        :param times: alternatively, image times for the TIME= keyword, e.g. '12:15:00', on day if given
+        :param prefetch: number of images fetched ahead of the caller
+        """
+        if (positions is None) == (times is None):
+            raise ValueError('give either positions or times')
+        if positions is not None:
+            requests = [(p, with_aget_position(request_string, p)) for p in positions]
+        else:
+            requests = [(t, with_aget_time(request_string, t, day)) for t in times]
+        return AgetLoop(self, requests, prefetch, timeout=timeout)
+
+    def _resume(self, request_string, state, timeout=None):
+        """
+        request the image lines a partial reply in state lacks, splicing them and the comments into its buffer
+        The request is pinned to the day and time of the partial image, so a relative position such as -1 does not
+        pick up an image that arrived since; a reply for any other image raises ImageChanged.
+        """
+        buf = state['buffer']
+        hdr = adde_header_t.from_buffer_copy(buf[:256])
+        line_bytes = _line_bytes(hdr)
+        data_end = hdr.data_block_offset + hdr.lines * line_bytes
+        # at least one line is asked for, bringing the comments with it
+        first = min(hdr.lines - 1, (state['received'] - hdr.data_block_offset) // line_bytes)
+        text = with_aget_placement(request_string, 'IU', hdr.line_ul + first * hdr.line_res, hdr.element_ul,
+                                   hdr.lines - first, hdr.elements)
+        year, day = divmod(hdr.yyyddd, 1000)
+        # header years count from 1900 in three digits, DAY= takes four
+        yyyyddd = '%04d%03d' % (year + 1900 if year < 1000 else year, day)
+        hhmmss = '%02d:%02d:%02d' % (hdr.hhmmss // 10000, hdr.hhmmss // 100 % 100, hdr.hhmmss % 100)
+        text = with_aget_time(text, hhmmss, yyyyddd)
+        start = hdr.data_block_offset + first * line_bytes
+        view = memoryview(buf)
+        dest = view[start:data_end]
+        LOG.info('resuming at line %d of %d' % (first, hdr.lines))
+
+        def image_buffer(header):
+            if (header.yyyddd, header.hhmmss) != (hdr.yyyddd, hdr.hhmmss):
+                raise ImageChanged('resumed reply is for the image of %d %06d, not %d %06d' % (
+                    header.yyyddd, header.hhmmss, hdr.yyyddd, hdr.hhmmss))
+            return dest
+
+        def receive(sock):
+            try:
+                parts = _recv_aget_parts(sock, image_buffer)
+            except IncompleteTransfer as err:
+                if err.buffer is dest:
+                    state['received'] = start + err.received
+                raise
+            comments = parts[2]
+            if len(comments) != len(buf) - data_end:
+                raise ValueError('resumed reply carries %d comment bytes, expected %d' % (len(comments),
+                                                                                          len(buf) - data_end))
+            view[data_end:] = comments
+            state['received'] = len(buf)
+
+        self._transact(text, receive, timeout)
+
+    def aget_resumable(self, request_string, retries=4, backoff=0.5, max_backoff=30.0, timeout=None):
+        """
+        fetch one AGET, surviving dropped connections: the partly filled buffer is kept, and only the image
+        lines it lacks are requested again, in IU placement, and spliced into it
+        Attempts after the first wait backoff seconds, doubling each time up to max_backoff.
+        A drop before the data block, or in an image with line prefixes, means fetching everything again,
+        as does a resumed reply for another image than the one partly received.
+        :param retries: number of attempts after the first
+        :return: the same result structure as aget()
+        """
+        state = dict(buffer=None, received=0)
+
+        def receive(sock):
+            total_bytes = _recv_length_word(sock)
+            state['buffer'] = bytearray(total_bytes)
+            state['received'] = 0
+            try:
+                _recv_all(sock, total_bytes, state['buffer'])
+            except IncompleteTransfer as err:
+                state['received'] = err.received
+                raise
+            state['received'] = total_bytes
+
+        attempt = 0
+        while True:
+            try:
+                buf = state['buffer']
+                resumable = False
+                if buf is not None and state['received'] >= 256:
+                    hdr = adde_header_t.from_buffer_copy(buf[:256])
+                    resumable = hdr.line_prefix_length == 0 and state['received'] >= hdr.data_block_offset
+                if resumable:
+                    self._resume(request_string, state, timeout)
+                else:
+                    self._transact(request_string, receive, timeout)
+                return map_aget(state['buffer'])
+            except (IncompleteTransfer, socket.error, ImageChanged) as err:
+                if isinstance(err, ImageChanged):
+                    state['buffer'], state['received'] = None, 0
+                attempt += 1
+                if attempt > retries:
+                    raise
+                delay = min(max_backoff, backoff * 2 ** (attempt - 1))
+                LOG.warning('transfer failed after %d bytes (%s), attempt %d of %d in %.1fs' % (
+                    state['received'], err, attempt, retries, delay))
+                time.sleep(delay)
+
+    def release(self, zult):
+        """
+        return the receive buffer of an aget() result to the session's BufferPool, if it has one
+        """
+        if self.buffers is not None:
+            release_aget(zult, self.buffers)
+
+    def _finish(self, sock, complete):
+        sock = getattr(sock, 'sock', sock)
+        if complete:
+            self.pool.release(sock, self.host, self.port)
+        else:
+            self.pool.discard(sock)
+
+    def aget_stream(self, request_string, lines_per_block=64, callback=None, timeout=None):
+        """
+        start an AGET and return an AgetStream yielding image lines as they arrive
+        """
+        server, client = self._inaddrs()
+        bfr = form_aget(request_string, self.host, self.port, self.user, self.project, self.password,
+                        server_inaddr=server, client_inaddr=client, compression=self.compression)
+        LOG.debug(repr(bfr))
+        s = self._connect(timeout)
+        try:
+            s.sendall(bfr)
+            return AgetStream(self._reader(s), lines_per_block, callback, release=self._finish)
+        except Exception:
+            self.pool.discard(s)
+            raise
+
 TEST_REQ_STRING = ("EASTL FD -1 EC 45 90 X 480 640 STYPE=VISR BAND= 1 TRACE=0 TIME="
                        "X X I SPAC=1 UNIT=BRIT AUX=YES NAV= DAY= DOC=NO VERSION=1")
 
@@ -393,6 +1606,38 @@ def _test_smoke():
     return ses.aget(TEST_REQ_STRING)
 
 
+class test_convert(unittest.TestCase):
+
+    def test_payload_to_native(self):
+        h = adde_header_t()
+        h.image_type, h.lines, h.elements, h.bytes_per_element = 4, 2, 3, 2
+        h.nav_block_offset, h.data_block_offset = 256, 256 + 12
+        h.memo, h.source_type, h.cal_type = b'memo', b'GVAR', b'RAW'
+        h.original_source_type, h.units = struct.unpack('>2i', b'GVARBRIT')
+        payload = bytearray(h) + b'RECT' + struct.pack('!2i', 7, -8) + struct.pack('!6h', *range(6))
+        hdr = payload_to_native(payload)
+        self.assertEqual((hdr.image_type, hdr.lines, hdr.elements), (4, 2, 3))
+        self.assertEqual((hdr.memo, hdr.source_type, hdr.cal_type), (b'memo', b'GVAR', b'RAW'))
+        self.assertEqual(bytes(payload[56 * 4:58 * 4]), b'GVARBRIT')
+        self.assertEqual(bytes(payload[256:260]), b'RECT')
+        self.assertEqual(list(np.frombuffer(payload, '=i4', 2, 260)), [7, -8])
+        self.assertEqual(list(np.frombuffer(payload, '=i2', 6, 268)), list(range(6)))
+        from pyadde.cal import image_units
+        self.assertEqual(image_units(hdr), 'BRIT')
+        self.assertEqual(image_units(native_to_payload(payload)), 'BRIT')
+
+    def test_cal_block(self):
+        h = adde_header_t()
+        h.image_type, h.lines, h.elements, h.bytes_per_element = 4, 1, 2, 1
+        h.nav_block_offset, h.cal_block_offset, h.data_block_offset = 256, 264, 264 + 12
+        payload = bytearray(h) + b'RECT' + struct.pack('!i', 5) + b'RAW ' + struct.pack('!2i', 9, -10) + b'\1\2'
+        payload_to_native(payload)
+        self.assertEqual(bytes(payload[264:268]), b'RAW ')
+        self.assertEqual(list(np.frombuffer(payload, '=i4', 2, 268)), [9, -10])
+        native_to_payload(payload)
+        self.assertEqual(bytes(payload[264:]), b'RAW ' + struct.pack('!2i', 9, -10) + b'\1\2')
+
+
 class test_adde(unittest.TestCase):
     ses = None
     def setUp(self):
@@ -408,31 +1653,352 @@ class test_adde(unittest.TestCase):
         return zult
 
 
-
-
-
-
-def main():
+class test_session(unittest.TestCase):
+    "Session features against a local server.AddeServer"
+    srv = None
+
+    def serve(self, latency=0.0, drop_after=None, drops=0, **source_options):
+        """
+        start a local server answering from a SyntheticSource with source_options, closed when the test ends
+        """
+        # server builds on this module, so it is imported once both are loaded
+        from pyadde.server import AddeServer, SyntheticSource
+        self.srv = AddeServer(SyntheticSource(**source_options), latency=latency, drop_after=drop_after,
+                              drops=drops).start()
+        self.addCleanup(self.srv.close)
+        return self.srv
+
+    def session(self, **options):
+        "Session on the server started by serve(), with a connection pool of its own"
+        return Session('127.0.0.1', self.srv.port, 'RKG', 6999, '', pool=ConnectionPool(), **options)
+
+    @staticmethod
+    def pixels(line_ul, element_ul, lines, elements, band=1, bytes_per_element=2):
+        "synthetic pixel values of a sector in image coordinates, see server.pixel_value"
+        from pyadde.server import pixel_value
+        return pixel_value(line_ul + np.arange(lines)[:, None], element_ul + np.arange(elements)[None, :], band,
+                           bytes_per_element)
+
+    def test_bands(self):
+        self.serve(bands=(2, 7, 14), bytes_per_element=1)
+        zult = self.session().aget(TEST_REQ_STRING.replace('EC 45 90', 'IU 1 1').replace('BAND= 1', 'BAND=ALL'))
+        self.assertEqual(list(zult.band_arrays), [2, 7, 14])
+        self.assertEqual(zult.image_array.shape, (480, 640, 3))
+        np.testing.assert_array_equal(zult.band_array(7), self.pixels(1, 1, 480, 640, 7, 1))
+        self.assertFalse(zult.band_array(14).flags.owndata)
+
+    def test_line_prefixes(self):
+        self.serve(bands=(3, 4), prefix=(8, 4, 2), validity_code=7)
+        zult = self.session().aget(TEST_REQ_STRING.replace('EC 45 90', 'IU 10 1').replace('BAND= 1', 'BAND=ALL'))
+        self.assertEqual(zult.line_prefix_length, 18)
+        expected = self.pixels(10, 1, 480, 640, 4)
+        np.testing.assert_array_equal(zult.band_array(4), expected)
+        prefixes = zult.line_prefixes
+        self.assertTrue((prefixes['validity'] == 7).all())
+        np.testing.assert_array_equal(prefixes['doc'][:, 0], np.arange(10, 490) % 256)
+        self.assertEqual(list(prefixes['band'][0]), [3, 4])
+        zult.to_native()
+        np.testing.assert_array_equal(zult.band_array(4), expected)
+        self.assertEqual(list(prefixes['band'][0]), [3, 4])
+
+    def test_loop(self):
+        self.serve()
+        buffers = BufferPool()
+        ses = self.session(buffers=buffers)
+        steps = [step for step, zult in ses.aget_loop(TEST_REQ_STRING, positions=range(-4, 1), prefetch=2)]
+        self.assertEqual(steps, [-4, -3, -2, -1, 0])
+        self.assertLessEqual(buffers.misses, 4)
+        self.assertEqual(buffers.stats()['pooled_buffers'], buffers.misses)
+
+    def test_resume(self):
+        srv = self.serve(comments=2, drop_after=300000, drops=2)
+        text = TEST_REQ_STRING.replace('EC 45 90', 'IU 1 1')
+        zult = self.session().aget_resumable(text, backoff=0.01)
+        payload = bytes(bytearray(zult))
+        self.assertEqual(payload, bytes(srv.source.aget(text)))
+        # the retries carried only the lines not yet received
+        self.assertEqual(srv.wait(3), 3)
+        self.assertLess(srv.stats()['bytes_sent'], len(payload) + 8192)
+
+    def test_resume_new_image(self):
+        srv = self.serve(drop_after=300000, drops=1)
+        source, requests = srv.source, []
+        fetch = source.aget
+
+        def aget(text):
+            # a newer image becomes the most recent once the first transfer has started
+            requests.append(text)
+            if len(requests) > 1:
+                source.hhmmss = 120100
+            return fetch(text)
+        source.aget = aget
+        zult = self.session().aget_resumable(TEST_REQ_STRING.replace('EC 45 90', 'IU 1 1'), backoff=0.01)
+        _, keywords = parse_request_text(requests[1])
+        self.assertEqual((keywords['TIME'], keywords['DAY']), ('12:00:00 12:00:00 I', '2014164'))
+        # the resumed reply was for the newer image, so everything was fetched again
+        self.assertEqual(len(requests), 3)
+        self.assertEqual((zult.hhmmss, zult.lines), (120100, 480))
+        np.testing.assert_array_equal(zult.image_array, self.pixels(1, 1, 480, 640))
+
+    def test_gzip(self):
+        srv = self.serve(lines=1000, elements=1000)
+        ses = self.session(compression='gzip')
+        zult = ses.aget(TEST_REQ_STRING.replace('X 480 640', 'X 1000 1000'))
+        srv.wait(1)
+        np.testing.assert_array_equal(zult.image_array, self.pixels(45 - 500, 90 - 500, 1000, 1000))
+        self.assertLess(srv.stats()['bytes_sent'], zult.lines * zult.elements)
+        self.assertEqual(len(ses.adir('EASTL FD ALL')), 10)
+        self.assertRaises(ValueError, self.session, compression='compress')
+
+    def test_tiled(self):
+        self.serve(comments=3)
+        ses = self.session()
+        # 101 lines in 4 tiles leaves a short last tile
+        text = TEST_REQ_STRING.replace('X 480 640', 'X 101 640')
+        single = ses.aget(text)
+        tiled = ses.aget_tiled(text, tiles=4)
+        self.assertEqual((tiled.lines, tiled.line_ul), (101, 45 - 50))
+        self.assertEqual(bytes(bytearray(tiled)), bytes(bytearray(single)))
+        self.assertEqual(self.srv.wait(6), 6)
+
+    def test_tiled_workers(self):
+        srv = self.serve(latency=0.05)
+        ses = self.session()
+        transact, lock = ses._transact, threading.Lock()
+        counts = dict(active=0, peak=0)
+
+        def counted(*args, **kwargs):
+            with lock:
+                counts['active'] += 1
+                counts['peak'] = max(counts['peak'], counts['active'])
+            try:
+                return transact(*args, **kwargs)
+            finally:
+                with lock:
+                    counts['active'] -= 1
+        ses._transact = counted
+        text = TEST_REQ_STRING.replace('X 480 640', 'X 100 640')
+        tiled = ses.aget_tiled(text, tiles=10, max_workers=2)
+        np.testing.assert_array_equal(tiled.image_array, self.pixels(45 - 50, 90 - 320, 100, 640))
+        # the probe and ten tiles, no more than two at a time
+        self.assertEqual(srv.wait(11), 11)
+        self.assertEqual(counts['peak'], 2)
+
+    def test_stream(self):
+        self.serve(comments=2)
+        text = TEST_REQ_STRING.replace('EC 45 90', 'IU 1 1').replace('X 480 640', 'X 101 640')
+        rows = []
+        stream = self.session().aget_stream(text, lines_per_block=32)
+        for first, lines in stream:
+            rows.append((first, np.frombuffer(lines, dtype='>i2').reshape(-1, 640).copy()))
+        self.assertEqual([first for first, _ in rows], [0, 32, 64, 96])
+        np.testing.assert_array_equal(np.concatenate([block for _, block in rows]), self.pixels(1, 1, 101, 640))
+        self.assertEqual(len(stream.comments), 2)
+
+    def test_cache(self):
+        import shutil
+        import tempfile
+        from pyadde.cache import AgetCache
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        srv = self.serve()
+        ses = self.session(cache=AgetCache(directory))
+        first = ses.aget(TEST_REQ_STRING)
+        # the same request with its keywords in another order and spacing
+        reordered = ("EASTL FD -1 EC 45 90 X 480 640 BAND=1 STYPE=VISR TRACE=0 TIME=X X I SPAC=1 UNIT=BRIT "
+                     "AUX=YES NAV= DAY= DOC=NO VERSION=1")
+        again = ses.aget(reordered)
+        self.assertEqual(bytes(bytearray(again)), bytes(bytearray(first)))
+        self.assertEqual((ses.cache.hits, ses.cache.misses), (1, 1))
+        self.assertEqual(srv.wait(1), 1)
+
+    def test_coalesce(self):
+        srv = self.serve(latency=0.3)
+        buffers = BufferPool()
+        ses = self.session(buffers=buffers, coalescer=RequestCoalescer())
+        start = threading.Barrier(5)
+        results = []
+
+        def fetch():
+            start.wait()
+            results.append(ses.aget(TEST_REQ_STRING))
+        callers = [threading.Thread(target=fetch) for _ in range(5)]
+        for t in callers:
+            t.start()
+        for t in callers:
+            t.join()
+        self.assertEqual(len(set(id(z) for z in results)), 1)
+        self.assertEqual(ses.coalescer.stats(), dict(transfers=1, saved=4, in_flight=0))
+        self.assertEqual(srv.wait(1), 1)
+        for zult in results:
+            ses.release(zult)
+        # the shared buffer goes back to the pool once, after the last caller releases it
+        self.assertEqual(buffers.stats()['pooled_buffers'], 1)
+        self.assertEqual(srv.stats()['requests'], 1)
+
+    def test_stale_connection(self):
+        from unittest import mock
+        srv = self.serve()
+        ses = self.session()
+        # a pooled connection the server closes after acquire() has found it alive
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        stale = socket.create_connection(listener.getsockname())
+        listener.accept()[0].close()
+        listener.close()
+        ses.pool._idle[('127.0.0.1', srv.port)] = [(stale, time.time())]
+        with mock.patch('pyadde.pool._is_reusable', return_value=True):
+            zult = ses.aget(TEST_REQ_STRING)
+        np.testing.assert_array_equal(zult.image_array, self.pixels(45 - 240, 90 - 320, 480, 640))
+        # the stale connection was taken from the pool, the retry made a new one without counting a miss
+        stats = ses.pool.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 0))
+        self.assertEqual(srv.wait(1), 1)
+
+    def test_receive_to_file(self):
+        import shutil
+        import tempfile
+        from pyadde.area import AreaFile
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'AREA0001')
+        self.serve(comments=2)
+        text = TEST_REQ_STRING.replace('EC 45 90', 'IU 1 1').replace('X 480 640', 'X 101 640')
+        zult = self.session().aget(text, path=path)
+        self.assertEqual(os.path.getsize(path), C.sizeof(zult))
+        with AreaFile(path) as area:
+            self.assertFalse(area.native)
+            self.assertEqual((area.header.lines, area.header.elements), (101, 640))
+            np.testing.assert_array_equal(area.image, self.pixels(1, 1, 101, 640))
+            self.assertEqual(len(area.comments), 2)
+
+    def test_receive_to_file_dropped(self):
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'AREA0001')
+        self.serve(drop_after=50000, drops=1)
+        self.assertRaises(IncompleteTransfer, self.session().aget, TEST_REQ_STRING, path=path)
+        # the partly written file is removed
+        self.assertFalse(os.path.exists(path))
+
+    def test_main(self):
+        import io
+        import shutil
+        import tempfile
+        from contextlib import redirect_stdout
+        from pyadde.area import AreaFile
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        requests = os.path.join(directory, 'requests')
+        text = TEST_REQ_STRING.replace('EC 45 90', 'IU 1 1').replace('X 480 640', 'X 20 30')
+        with open(requests, 'w') as fp:
+            fp.write('# the first reply is cut off\n%s\n\n%s\n' % (text, text))
+        expected = self.pixels(1, 1, 20, 30)
+        for output_format in ('raw', 'area', 'npy'):
+            output = os.path.join(directory, output_format)
+            os.mkdir(output)
+            srv = self.serve(drop_after=1000, drops=1)
+            with redirect_stdout(io.StringIO()) as out:
+                status = main(['-s', '127.0.0.1', '-P', str(srv.port), '-j', '1', '-o', output,
+                               '-f', output_format, requests])
+            self.assertEqual(status, 1)
+            self.assertTrue(out.getvalue().startswith('1 fetched, 1 failed'))
+            if output_format == 'npy':
+                self.assertEqual(os.listdir(output), ['AREA0002.npy'])
+                np.testing.assert_array_equal(np.load(os.path.join(output, 'AREA0002.npy')), expected)
+                continue
+            # a partly received raw file is removed too
+            self.assertEqual(os.listdir(output), ['AREA0002'])
+            with AreaFile(os.path.join(output, 'AREA0002')) as area:
+                self.assertEqual(area.native, output_format == 'area')
+                np.testing.assert_array_equal(area.image, expected)
+
+
+
+
+
+
+def _read_requests(paths):
+    "AGET request strings from files, '-' being stdin, one per line; blank lines and # comments are skipped"
+    for path in paths:
+        fp = sys.stdin if path == '-' else open(path)
+        try:
+            for line in fp:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    yield line
+        finally:
+            if fp is not sys.stdin:
+                fp.close()
+
+
+def _fetch_to_file(ses, text, path, output_format, timeout=None):
+    """
+    fetch one AGET and write it to path as soon as it arrives
+    :param output_format: 'raw' receives the payload straight into path, a big-endian AREA file;
+        'area' writes a native-order AREA file; 'npy' saves the native-order image array
+    :return: (path written, bytes received)
+    """
+    if output_format == 'raw':
+        zult = ses.aget(text, timeout, path=path)
+        return path, C.sizeof(zult)
+    zult = ses.aget(text, timeout)
+    try:
+        nbytes = C.sizeof(zult)
+        if output_format == 'area':
+            from pyadde.area import AreaFile
+            AreaFile.write(path, zult).close()
+        else:
+            path += '.npy'
+            np.save(path, zult.to_native())
+    finally:
+        ses.release(zult)
+    return path, nbytes
+
+
+def main(argv=None):
+    """
+    command line entry point
+    :param argv: arguments, default sys.argv[1:]
+    :return: exit status, 1 if any request or self-test failed
+    """
     import argparse
-    description = """A boilerplate script for basic python module appearance.
-Doesn't actually do anything.
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    from pyadde.metrics import TimingAggregator
+    description = """Fetch AGET requests, one per line of the given files or stdin, concurrently,
+writing each image as it completes to AREAnnnn in the output directory, numbered in request order.
 """
     parser = argparse.ArgumentParser(description=description)
-    # parser.add_argument('-t', '--test', dest="self_test",
-    #                     action="store_true", default=False, help="run self-tests")
+    parser.add_argument('-t', '--test', dest="self_test",
+                        action="store_true", default=False, help="run self-tests")
     parser.add_argument('-v', '--verbose', dest='verbosity', action="count", default=0,
                         help='each occurrence increases verbosity 1 level through ERROR-WARNING-INFO-DEBUG')
+    parser.add_argument('-s', '--server', default='eastl.ssec.wisc.edu', help='ADDE server host')
+    parser.add_argument('-P', '--port', type=int, default=112, help='ADDE server port')
+    parser.add_argument('-u', '--user', default='RKG', help='user initials, up to 4 characters')
+    parser.add_argument('-p', '--project', type=int, default=6999, help='project number')
+    parser.add_argument('--password', default='', help='password')
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='number of concurrent fetches')
+    parser.add_argument('-o', '--output-dir', default='.', help='directory to write images to')
+    parser.add_argument('-f', '--format', dest='output_format', choices=('area', 'raw', 'npy'), default='area',
+                        help='native AREA file, the payload as received (a big-endian AREA file), '
+                             'or a NumPy .npy image array')
+    parser.add_argument('--first', type=int, default=1, help='number of the first output file')
+    parser.add_argument('--timeout', type=float, default=None, help='socket timeout in seconds')
+    parser.add_argument('-z', '--gzip', dest='compression', action='store_const', const='gzip', default=None,
+                        help='ask for gzip-compressed replies')
     # http://docs.python.org/2.7/library/argparse.html#nargs
-    #parser.add_argument('--stuff', nargs='5', dest='my_stuff',
-    #                    help="one or more random things")
-    parser.add_argument('pos_args', nargs='*',
-                        help="positional arguments don't have the '-' prefix")
-    args = parser.parse_args()
+    parser.add_argument('pos_args', nargs='*', metavar='requests',
+                        help="files of AGET request strings, one per line; '-' or none for stdin")
+    args = parser.parse_args(argv)
 
-
-    if not args.pos_args:
-        unittest.main()
-        return 0
+    if args.self_test:
+        # by name, so the tests are found from the pyadde console script too, whose __main__ is the script
+        tests = unittest.main(module='pyadde.adde', argv=sys.argv[:1], exit=False)
+        return 0 if tests.result.wasSuccessful() else 1
 
     levels = [logging.ERROR, logging.WARN, logging.INFO, logging.DEBUG]
     if 'DEBUG' in os.environ:
@@ -441,17 +2007,38 @@ Doesn't actually do anything.
         verb = args.verbosity
     logging.basicConfig(level=levels[min(3, verb)])
 
-
-    # if not args.pos_args:
-    #     print("running _test_request, writing request to /tmp/request.bin (next try 'od -t x1 /tmp/request.bin')")
-    #     req = _test_request()
-    #     with open('/tmp/request.bin', 'wb') as fp:
-    #         fp.write(req)
-    #     parser.error("incorrect arguments, try -h or --help.")
-    #     return 9
-
-    # FIXME - main() logic code here
-    return 0
+    timings = TimingAggregator()
+    ses = Session(args.server, args.port, args.user, args.project, args.password,
+                  buffers=None if args.output_format == 'raw' else BufferPool(), instrument=timings,
+                  compression=args.compression)
+    requests = _read_requests(args.pos_args or ['-'])
+    done = failed = nbytes = 0
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        futures = {}
+        for index, text in enumerate(requests, args.first):
+            path = os.path.join(args.output_dir, 'AREA%04d' % index)
+            futures[pool.submit(_fetch_to_file, ses, text, path, args.output_format, args.timeout)] = text
+        for future in as_completed(futures):
+            try:
+                path, size = future.result()
+            except Exception as err:
+                failed += 1
+                LOG.error('%s failed: %s' % (futures[future], err))
+                continue
+            done += 1
+            nbytes += size
+            LOG.info('wrote %s (%d bytes)' % (path, size))
+    elapsed = time.time() - start
+
+    print('%d fetched, %d failed, %.1f MB in %.2f s, %.2f MB/s' % (
+        done, failed, nbytes / 1e6, elapsed, nbytes / 1e6 / elapsed if elapsed else 0.0))
+    summary = timings.summary()
+    for phase in ('ttfb', 'transfer', 'total'):
+        if phase in summary:
+            print('%-8s p50 %.3f s  p95 %.3f s  p99 %.3f s' % ((phase, ) + tuple(summary[phase][p]
+                                                                               for p in ('p50', 'p95', 'p99'))))
+    return 1 if failed else 0
 
 
 if __name__=='__main__':
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""aio.py
+
+asyncio flavor of adde.Session, for running many AGET transfers concurrently.
+Requires Python 3.
+
+Copyright (c) 2014 University of Wisconsin SSEC. All rights reserved.
+"""
+
+import asyncio
+import logging
+import struct
+import unittest
+import weakref
+
+from pyadde.adde import form_aget, map_aget, _inaddr
+from pyadde.pool import DEFAULT_RESOLVER
+
+LOG = logging.getLogger(__name__)
+
+# largest single read handed to the stream reader while filling a payload buffer
+READ_CHUNK = 1 << 18
+
+
+class HostLimiter(object):
+    """
+    per-(host, port) semaphores capping how many transfers may be in flight against one server
+    asyncio semaphores belong to one event loop, so each running loop gets its own set;
+    the cap applies within a loop
+    """
+    per_host = None
+
+    def __init__(self, per_host=4):
+        self.per_host = per_host
+        self._sems = weakref.WeakKeyDictionary()  # event loop -> {(host, port): Semaphore}
+
+    def __call__(self, host, port):
+        sems = self._sems.setdefault(asyncio.get_running_loop(), {})
+        key = (host, port)
+        sem = sems.get(key)
+        if sem is None:
+            sem = sems[key] = asyncio.Semaphore(self.per_host)
+        return sem
+
+
+# shared by every AsyncSession unless one is given its own
+DEFAULT_LIMITER = HostLimiter()
+
+
+async def _read_length_word(reader):
+    total_bytes, = struct.unpack('!l', await reader.readexactly(4))
+    return total_bytes
+
+
+async def _read_all(reader, toread, buffer=None):
+    "asyncio counterpart of adde._recv_all, filling buffer a chunk at a time"
+    LOG.debug('about to read %d bytes' % toread)
+    buf = buffer if (buffer is not None) else bytearray(toread)
+    view = memoryview(buf)
+    offset = 0
+    while offset < toread:
+        chunk = await reader.read(min(READ_CHUNK, toread - offset))
+        if not chunk:
+            raise IOError('expecting %d more bytes' % (toread - offset))
+        view[offset:offset + len(chunk)] = chunk
+        offset += len(chunk)
+    return buf
+
+
+async def read_aget(reader):
+    """
+    read an AGET reply from an asyncio stream and return a structure mapped over it, see adde.map_aget
+    """
+    total_bytes = await _read_length_word(reader)
+    blob = await _read_all(reader, total_bytes)
+    return map_aget(blob)
+
+
+class AsyncSession(object):
+    """
+    asyncio ADDE session, holding the same credentials as adde.Session
+
+    Transfers to one server are capped by a HostLimiter shared across sessions;
+    gather() runs a batch of requests concurrently within that cap.
+    """
+    host = None
+    user = None
+    port = None
+    project = None
+    password = None
+    limiter = None
+    resolver = None
+    _server_inaddr = None
+    _client_inaddr = None
+
+    def __init__(self, host, port, user, project, password, limiter=None, resolver=None):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.project = project
+        self.password = password
+        self.limiter = limiter if (limiter is not None) else DEFAULT_LIMITER
+        self.resolver = resolver if (resolver is not None) else DEFAULT_RESOLVER
+
+    def _inaddrs(self):
+        self._server_inaddr = _inaddr(self.resolver.address(self.host))
+        self._client_inaddr = _inaddr(self.resolver.local_address())
+        return self._server_inaddr, self._client_inaddr
+
+    async def _transfer(self, bfr):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            writer.write(bytes(bfr))
+            await writer.drain()
+            return await read_aget(reader)
+        finally:
+            writer.close()
+            await writer.wait_closed()
+
+    async def aget(self, request_string, timeout=None):
+        """
+        fetch one AGET request, returning the same result structure as adde.Session.aget
+        """
+        loop = asyncio.get_running_loop()
+        # resolution may block on DNS; the resolver cache makes this cheap after the first call
+        server, client = await loop.run_in_executor(None, self._inaddrs)
+        bfr = form_aget(request_string, self.host, self.port, self.user, self.project, self.password,
+                        server_inaddr=server, client_inaddr=client)
+        LOG.debug(repr(bfr))
+        async with self.limiter(self.host, self.port):
+            return await asyncio.wait_for(self._transfer(bfr), timeout)
+
+    async def gather(self, request_strings, timeout=None, return_exceptions=False):
+        """
+        fetch a batch of AGET requests concurrently, returning results in request order
+        """
+        return await asyncio.gather(*[self.aget(r, timeout) for r in request_strings],
+                                    return_exceptions=return_exceptions)
+
+
+class test_aio(unittest.TestCase):
+
+    def test_gather(self):
+        import numpy as np
+        from pyadde.adde import TEST_REQ_STRING
+        from pyadde.server import AddeServer, SyntheticSource, pixel_value
+        with AddeServer(SyntheticSource(), latency=0.02) as srv:
+            ses = AsyncSession('127.0.0.1', srv.port, 'RKG', 6999, '', limiter=HostLimiter(per_host=2))
+            texts = [TEST_REQ_STRING.replace('EC 45 90', 'IU %d 1' % (1 + 10 * k)) for k in range(10)]
+            # a second event loop reuses the limiter that the first one contended
+            for _ in range(2):
+                zults = asyncio.run(ses.gather(texts))
+                self.assertEqual([z.line_ul for z in zults], [1 + 10 * k for k in range(10)])
+            expected = pixel_value(np.arange(91, 571)[:, None], np.arange(1, 641)[None, :], 1, 2)
+            np.testing.assert_array_equal(zults[9].image_array, expected)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""area.py
+
+McIDAS AREA files: writing AGET results to disk and memory-mapped, lazy reading.
+
+An AREA file has the same layout as an AGET payload: 64-word header, navigation, calibration,
+data and comment blocks. Files are written in native byte order, character words left as text;
+either byte order is read, recognizing it from the image type word, which is always 4.
+http://www.ssec.wisc.edu/mcidas/doc/prog_man/current/formats-1.html#13797
+
+Copyright (c) 2014 University of Wisconsin SSEC. All rights reserved.
+"""
+
+import ctypes as C
+import logging
+import mmap
+import os
+import shutil
+import sys
+import unittest
+
+import numpy as np
+
+from pyadde.adde import (AREA_HEADER_FIELDS, CARD_SIZE, area_header_t, adde_header_t, line_prefix_dtype,
+                         payload_to_native, _find_blocks, _image_dtype, _line_bytes, _swap_block)
+
+LOG = logging.getLogger(__name__)
+
+AREA_IMAGE_TYPE = 4
+
+# write payloads to file in blocks of about this many bytes
+COPY_CHUNK = 1 << 22
+
+
+if sys.byteorder == 'little':
+    swapped_header_t = adde_header_t
+else:
+    class swapped_header_t(C.LittleEndianStructure):
+        "an area header in the byte order opposite to this machine's"
+        _pack_ = 1
+        _fields_ = AREA_HEADER_FIELDS
+
+
+class AreaFile(object):
+    """
+    memory-mapped AREA file; header, blocks and image are views that read only the pages touched
+
+    e.g. AreaFile.write('/data/AREA0001', ses.aget(req)).image[100:200, 300:400].mean()
+    """
+    path = None
+    header = None
+    native = None
+
+    def __init__(self, path, writable=False):
+        """
+        :param path: AREA file to open
+        :param writable: map the file shared and writable; otherwise changes stay private to this mapping
+        """
+        self.path = path
+        with open(path, 'r+b' if writable else 'rb') as fp:
+            self._mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_COPY)
+        hdr = area_header_t.from_buffer(self._mm)
+        if hdr.image_type == AREA_IMAGE_TYPE:
+            self.native = True
+        else:
+            hdr = swapped_header_t.from_buffer(self._mm)
+            if hdr.image_type != AREA_IMAGE_TYPE:
+                raise ValueError('%s is not an AREA file' % path)
+            self.native = False
+        self.header = hdr
+        self._order = '=' if self.native else ('>' if sys.byteorder == 'little' else '<')
+
+    def close(self):
+        self.header = None
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _block(self, loc):
+        return memoryview(self._mm)[loc.offset:loc.offset + loc.length] if loc.length > 0 else None
+
+    @property
+    def nav(self):
+        "navigation block as stored, a memoryview, or None"
+        return self._block(_find_blocks(self.header)[2])
+
+    @property
+    def cal(self):
+        "calibration block as stored, a memoryview, or None"
+        return self._block(_find_blocks(self.header)[1])
+
+    @property
+    def aux(self):
+        "auxiliary block as stored, a memoryview, or None"
+        return self._block(_find_blocks(self.header)[0])
+
+    def nav_network_order(self):
+        "copy of the navigation block in ADDE (network) order, as pyadde.nav expects"
+        nav = self.nav
+        if nav is None or not self.native or sys.byteorder == 'big':
+            return None if nav is None else bytes(nav)
+        # swapping is its own inverse, so the same word rules bring a native block back
+        return _swap_block(nav, nav=True)
+
+    @property
+    def image(self):
+        """
+        lines x elements ndarray over the data block, in the file's byte order; lines x elements x bands for several
+        line prefixes are skipped over by the line stride
+        """
+        h = self.header
+        bpe, bands = h.bytes_per_element, max(h.spectral_band_count, 1)
+        shape, strides = (h.lines, h.elements), (_line_bytes(h), bpe * bands)
+        if bands > 1:
+            shape, strides = shape + (bands, ), strides + (bpe, )
+        return np.ndarray(shape, dtype=_image_dtype(bpe, self._order), buffer=self._mm,
+                          offset=h.data_block_offset + h.line_prefix_length, strides=strides)
+
+    @property
+    def line_prefixes(self):
+        "structured array of the line prefixes, see adde.line_prefix_dtype, or None"
+        h = self.header
+        if h.line_prefix_length == 0:
+            return None
+        return np.ndarray((h.lines, ), dtype=line_prefix_dtype(h, self._order), buffer=self._mm,
+                          offset=h.data_block_offset)
+
+    @property
+    def comments(self):
+        "comment cards following the data block, as a list of byte strings"
+        h = self.header
+        start = h.data_block_offset + h.lines * _line_bytes(h)
+        return [bytes(self._mm[start + k * CARD_SIZE:start + (k + 1) * CARD_SIZE]) for k in range(h.comment_count)]
+
+    @classmethod
+    def write(cls, path, zult):
+        """
+        write an AGET result as a native-order AREA file and return it opened
+        """
+        payload = memoryview(np.frombuffer(zult, dtype=np.uint8))
+        tmp = path + '.tmp'
+        with open(tmp, 'w+b') as fp:
+            for start in range(0, len(payload), COPY_CHUNK):
+                fp.write(payload[start:start + COPY_CHUNK])
+            fp.flush()
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_WRITE)
+        try:
+            payload_to_native(mm, image=not zult._image_native).relative_position_within_dataset = 0
+            mm.flush()
+        finally:
+            mm.close()
+        os.rename(tmp, path)
+        return cls(path)
+
+
+class test_area(unittest.TestCase):
+
+    def test_round_trip(self):
+        import struct
+        import tempfile
+        from pyadde.adde import map_aget
+        h = adde_header_t()
+        h.image_type = AREA_IMAGE_TYPE
+        h.lines, h.elements, h.bytes_per_element = 3, 5, 2
+        h.nav_block_offset, h.data_block_offset, h.comment_count = 256, 256 + 16, 1
+        h.memo = b'round trip'
+        payload = bytearray(h) + b'RECT' + struct.pack('!3i', 1, 2, 3)
+        payload += struct.pack('!15h', *range(15)) + b'comment'.ljust(CARD_SIZE)
+        zult = map_aget(payload)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'AREA0001')
+        with AreaFile.write(path, zult) as area:
+            self.assertTrue(area.native)
+            self.assertEqual(area.header.memo, b'round trip')
+            self.assertEqual(area.image[2, 4], 14)
+            self.assertEqual(bytes(area.nav[:4]), b'RECT')
+            self.assertEqual(area.nav_network_order(), bytes(payload[256:272]))
+            self.assertEqual(area.comments[0].rstrip(), b'comment')
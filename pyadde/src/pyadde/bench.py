@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""bench.py
+
+Benchmarks of the receive, parse and conversion paths, written as JSON for tracking across releases.
+
+    python -m pyadde.bench -o bench-0.1.json
+    python -m pyadde.bench --quick
+
+Network benchmarks run against a loopback server.AddeServer, so results measure the client
+and the local TCP stack, not a real ADDE server.
+
+Copyright (c) 2014 University of Wisconsin SSEC. All rights reserved.
+"""
+
+import json
+import logging
+import platform
+import socket
+import sys
+import threading
+import time
+
+import numpy as np
+
+from pyadde import adde
+from pyadde.pool import ConnectionPool
+from pyadde.server import AddeServer, SyntheticSource, synthetic_area
+
+LOG = logging.getLogger(__name__)
+
+# image sizes (lines, elements) from a small sector up to a full disk
+IMAGE_SIZES = (
+    ('sector', 480, 640),
+    ('regional', 2000, 2000),
+    ('full_disk', 10848, 10848),
+)
+QUICK_SIZES = IMAGE_SIZES[:2]
+
+BYTES_PER_ELEMENT = (1, 2, 4)
+
+# sender chunk sizes for the _recv_all benchmark
+CHUNK_SIZES = (1 << 12, 1 << 16, 1 << 20, 1 << 24)
+
+# longer than the 120 characters that fit in adde_aget_t
+LONG_TEXT = adde.TEST_REQ_STRING + ' MAG=1 1 PLACE=ULEFT'
+
+
+def _timings(fn, repeat=5, number=1):
+    """
+    run fn number times per trial for repeat trials
+    :return: dict of seconds per call: best, median, mean; and the call count
+    """
+    per_call = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        per_call.append((time.perf_counter() - start) / number)
+    return dict(best=min(per_call), median=float(np.median(per_call)), mean=float(np.mean(per_call)),
+                calls=repeat * number)
+
+
+def bench_recv_all(nbytes=1 << 27, chunk_sizes=CHUNK_SIZES, repeat=3):
+    "_recv_all over a local socket pair, the peer sending in chunks of each size"
+    payload = bytearray(nbytes)
+    results = []
+    for chunk in chunk_sizes:
+        def trial():
+            rx, tx = socket.socketpair()
+
+            def send():
+                view = memoryview(payload)
+                for start in range(0, nbytes, chunk):
+                    tx.sendall(view[start:start + chunk])
+                tx.close()
+            t = threading.Thread(target=send)
+            t.start()
+            adde._recv_all(rx, nbytes)
+            t.join()
+            rx.close()
+        timing = _timings(trial, repeat)
+        timing.update(chunk_bytes=chunk, nbytes=nbytes, mb_per_s=nbytes / timing['best'] / 1e6)
+        results.append(timing)
+    return results
+
+
+def bench_map_aget(sizes=IMAGE_SIZES, repeat=5):
+    "map_aget over a received payload, with the result type built from scratch (cold) and from LAYOUT_CACHE (warm)"
+    results = []
+    for name, lines, elements in sizes:
+        for bpe in BYTES_PER_ELEMENT:
+            payload = synthetic_area(lines, elements, bytes_per_element=bpe)
+
+            def cold():
+                adde.LAYOUT_CACHE.clear()
+                adde.map_aget(payload)
+            results.append(dict(size=name, lines=lines, elements=elements, bytes_per_element=bpe,
+                                cold=_timings(cold, repeat), warm=_timings(lambda: adde.map_aget(payload), repeat)))
+    return results
+
+
+def bench_payload_to_native(sizes=IMAGE_SIZES, repeat=3):
+    "in-place conversion of a payload to native AREA layout; alternate calls convert back and forth"
+    results = []
+    for name, lines, elements in sizes:
+        for bpe in BYTES_PER_ELEMENT:
+            payload = synthetic_area(lines, elements, bytes_per_element=bpe)
+            state = dict(native=False)
+
+            def convert():
+                (adde.native_to_payload if state['native'] else adde.payload_to_native)(payload)
+                state['native'] = not state['native']
+            timing = _timings(convert, repeat)
+            timing.update(size=name, lines=lines, elements=elements, bytes_per_element=bpe,
+                          mb_per_s=len(payload) / timing['best'] / 1e6)
+            results.append(timing)
+    return results
+
+
+def bench_image_dir(entries=(10, 1000, 10000), comment_counts=(0, 10), repeat=3):
+    "structure_adde_image_dir_entry type construction, and receiving large directories as structures and as a table"
+    results = []
+    for comments in comment_counts:
+        total_bytes = 260 + comments * adde.CARD_SIZE
+
+        def cold():
+            adde.LAYOUT_CACHE.clear()
+            adde.structure_adde_image_dir_entry(total_bytes)
+        results.append(dict(kind='entry_type', comments=comments, cold=_timings(cold, repeat, 10),
+                            warm=_timings(lambda: adde.structure_adde_image_dir_entry(total_bytes), repeat, 1000)))
+    for count in entries:
+        with AddeServer(SyntheticSource(images=count)) as srv:
+            ses = adde.Session(srv.host, srv.port, 'BENC', 1, '', pool=ConnectionPool())
+            for kind, receive in (('structures', adde.recv_adde_image_dir), ('table', adde.recv_adde_image_dir_table)):
+                timing = _timings(lambda: ses._transact('BENCH ALL', receive, service='ADIR'), repeat)
+                timing.update(kind=kind, entries=count, entries_per_s=count / timing['best'])
+                results.append(timing)
+    return results
+
+
+def bench_form_aget(repeat=5, number=10000):
+    "request building rate, short text and text long enough to need the extended layout"
+    server = client = adde._inaddr('127.0.0.1')
+    results = []
+    for kind, text in (('short', 'EASTL FD -1 EC 45 90 X 480 640 BAND=1'), ('long', LONG_TEXT)):
+        timing = _timings(lambda: bytes(adde.form_aget(text, 'localhost', 112, 'BENC', 1, '', server_inaddr=server,
+                                                       client_inaddr=client)), repeat, number)
+        timing.update(kind=kind, text_length=len(text), requests_per_s=1.0 / timing['best'])
+        results.append(timing)
+    return results
+
+
+def bench_session_aget(sizes=IMAGE_SIZES, repeat=3):
+    "end-to-end Session.aget throughput against a loopback server"
+    results = []
+    for name, lines, elements in sizes:
+        for bpe in BYTES_PER_ELEMENT:
+            source = SyntheticSource(lines, elements, bytes_per_element=bpe)
+            text = adde.with_aget_placement(adde.TEST_REQ_STRING, 'IU', 1, 1, lines, elements)
+            with AddeServer(source) as srv:
+                ses = adde.Session(srv.host, srv.port, 'BENC', 1, '', pool=ConnectionPool())
+                ses.aget(text)  # warm up: the server builds and keeps the payload, the client its result type
+                timing = _timings(lambda: ses.aget(text), repeat)
+            nbytes = len(source.aget(text))
+            timing.update(size=name, lines=lines, elements=elements, bytes_per_element=bpe, nbytes=nbytes,
+                          mb_per_s=nbytes / timing['best'] / 1e6)
+            results.append(timing)
+    return results
+
+
+BENCHMARKS = (
+    ('recv_all', bench_recv_all),
+    ('map_aget', bench_map_aget),
+    ('payload_to_native', bench_payload_to_native),
+    ('image_dir', bench_image_dir),
+    ('form_aget', bench_form_aget),
+    ('session_aget', bench_session_aget),
+)
+
+
+def run(names=None, quick=False):
+    """
+    run the named benchmarks, or all of them
+    :param quick: leave out full-disk images and shrink the larger runs
+    :return: dict suitable for JSON, with the platform and versions alongside the results
+    """
+    options = dict(
+        recv_all=dict(nbytes=1 << 24) if quick else {},
+        map_aget=dict(sizes=QUICK_SIZES) if quick else {},
+        payload_to_native=dict(sizes=QUICK_SIZES) if quick else {},
+        image_dir=dict(entries=(10, 1000)) if quick else {},
+        form_aget=dict(number=1000) if quick else {},
+        session_aget=dict(sizes=QUICK_SIZES) if quick else {},
+    )
+    results = {}
+    for name, fn in BENCHMARKS:
+        if names and name not in names:
+            continue
+        LOG.info('running %s' % name)
+        results[name] = fn(**options[name])
+    return dict(
+        time=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        python=platform.python_version(),
+        numpy=np.__version__,
+        platform=platform.platform(),
+        quick=quick,
+        results=results,
+    )
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark pyadde receive, parse and conversion paths.")
+    parser.add_argument('-o', '--output', help='write JSON results here instead of stdout')
+    parser.add_argument('--quick', action='store_true', default=False, help='skip full-disk images')
+    parser.add_argument('-v', '--verbose', dest='verbosity', action="count", default=0,
+                        help='each occurrence increases verbosity 1 level through ERROR-WARNING-INFO-DEBUG')
+    parser.add_argument('benchmarks', nargs='*', help='benchmarks to run, of: %s' % ', '.join(n for n, _ in BENCHMARKS))
+    args = parser.parse_args()
+    levels = [logging.ERROR, logging.WARN, logging.INFO, logging.DEBUG]
+    logging.basicConfig(level=levels[min(3, args.verbosity)])
+
+    unknown = set(args.benchmarks) - set(n for n, _ in BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmarks: %s' % ', '.join(sorted(unknown)))
+    report = run(args.benchmarks, args.quick)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""cache.py
+
+On-disk cache of AGET replies, keyed by server and canonicalized request text.
+
+Copyright (c) 2014 University of Wisconsin SSEC. All rights reserved.
+"""
+
+import hashlib
+import logging
+import mmap
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from pyadde.adde import canonical_request_text, map_aget
+
+LOG = logging.getLogger(__name__)
+
+SUFFIX = '.adde'
+
+
+class AgetCache(object):
+    """
+    directory of raw AGET payloads, one file per distinct request
+
+    Entries older than ttl seconds are treated as missing, which matters for relative positions
+    such as -1 whose answer changes as new images arrive. Once the directory holds more than
+    max_bytes, least recently used entries are removed. Hits are mapped copy-on-write with mmap,
+    so only the pages actually touched are read from disk.
+    A file's mtime records when it was stored and its atime when it was last served.
+    """
+    directory = None
+    max_bytes = None
+    ttl = None
+    hits = 0
+    misses = 0
+    evictions = 0
+
+    def __init__(self, directory, max_bytes=2 << 30, ttl=300.0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def key(host, port, text):
+        canon = '%s:%d %s' % (host.lower(), port, canonical_request_text(text))
+        return hashlib.sha1(canon.encode('ascii')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def get(self, host, port, text):
+        """
+        return an AGET result mapped over the cached payload, or None
+        """
+        path = self._path(self.key(host, port, text))
+        now = time.time()
+        try:
+            st = os.stat(path)
+            if st.st_mtime + self.ttl < now:
+                os.unlink(path)
+                raise OSError('expired')
+            with open(path, 'rb') as fp:
+                mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_COPY)
+            os.utime(path, (now, st.st_mtime))
+        except (OSError, IOError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return map_aget(mm)
+
+    def put(self, host, port, text, zult):
+        """
+        store the payload behind an AGET result, then evict down to max_bytes
+        """
+        path = self._path(self.key(host, port, text))
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(memoryview(np.frombuffer(zult, dtype=np.uint8)))
+            os.rename(tmp, path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+        self.evict()
+
+    def evict(self):
+        "remove expired entries, then least recently used ones until under max_bytes"
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if st.st_mtime + self.ttl < now:
+                self._remove(path)
+            else:
+                entries.append((st.st_atime, st.st_size, path))
+        total = sum(e[1] for e in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def _remove(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            return
+        with self._lock:
+            self.evictions += 1
+
+    def stats(self):
+        sizes = [os.path.getsize(os.path.join(self.directory, n))
+                 for n in os.listdir(self.directory) if n.endswith(SUFFIX)]
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    entries=len(sizes), bytes=sum(sizes))
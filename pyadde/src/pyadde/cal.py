@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""cal.py
+
+Vectorized calibration of AGET images by table lookup.
+
+Every value an image of 1 or 2 bytes per element can hold is converted once into a lookup table,
+which is then applied to the whole image in a single indexing pass. Tables are cached by
+calibration type, cal block hash, band and units, so repeated fetches of a product reuse them.
+http://www.ssec.wisc.edu/mcidas/doc/prog_man/current/formats-1.html
+
+Copyright (c) 2014 University of Wisconsin SSEC. All rights reserved.
+"""
+
+import ctypes as C
+import hashlib
+import logging
+import struct
+import unittest
+
+import numpy as np
+
+from pyadde.adde import LRUCache, header_bands
+
+LOG = logging.getLogger(__name__)
+
+
+def _text_word(header, name):
+    """
+    four-character text held in an integer header word, e.g. the units word;
+    text words keep their byte order in both network and native headers, so they are read as bytes
+    """
+    raw = C.string_at(C.addressof(header) + getattr(type(header), name).offset, 4)
+    return raw.decode('ascii', 'replace').strip(' \0')
+
+
+def image_units(header):
+    "units of the stored image values, e.g. 'RAW', 'BRIT' or 'TEMP'"
+    return _text_word(header, 'units')
+
+
+def _stored_values(bytes_per_element, signed):
+    "every value an element can hold, ordered by its unsigned bit pattern, i.e. in table index order"
+    bits = 8 * bytes_per_element
+    values = np.arange(1 << bits, dtype=np.int64)
+    if signed:
+        values[1 << (bits - 1):] -= 1 << bits
+    return values
+
+
+class Calibration(object):
+    """
+    conversion of stored image values to physical units, for one band of one product
+    subclasses implement convert(); the table is derived from it
+    """
+    units = None
+    # whether stored values are read as signed integers when converting
+    signed = True
+
+    def __init__(self, header, cal_block=None, band=None, detector=None):
+        """
+        :param detector: detector whose coefficients to use, for sensors calibrating each one separately;
+            ignored by the others
+        """
+        self.header = header
+        self.cal_block = cal_block
+        self.band = band
+        self.detector = detector
+        self.units = image_units(header)
+        self.scaling = header.scaling
+
+    def convert(self, values, to_units):
+        """
+        return physical values in to_units for an array of stored values
+        """
+        if to_units != self.units:
+            raise ValueError('cannot calibrate %s to %s' % (self.units, to_units))
+        return values / (10.0 ** self.scaling)
+
+    def table(self, bytes_per_element, to_units):
+        "float32 lookup table indexed by the unsigned bit pattern of a stored value"
+        values = _stored_values(bytes_per_element, self.signed)
+        return np.asarray(self.convert(values, to_units), dtype=np.float32)
+
+
+class BritCalibration(Calibration):
+    """
+    McIDAS brightness (0-255) to infrared temperature (K) or visible albedo (%)
+    """
+    signed = False
+
+    def convert(self, values, to_units):
+        values = np.asarray(values, dtype=np.float64)
+        if to_units == 'BRIT':
+            return values
+        if to_units == 'TEMP':
+            return np.where(values > 176, 418.0 - values, 330.0 - values / 2.0)
+        if to_units == 'ALB':
+            return (values / 25.5) ** 2
+        raise ValueError('cannot calibrate BRIT to %s' % to_units)
+
+
+def gould_to_float(words):
+    """
+    IBM (Gould) hexadecimal floating point words, as GVAR cal blocks carry them, to float64
+    sign bit, 7-bit excess-64 power of 16, 24-bit fraction
+    """
+    words = np.asarray(words, dtype=np.uint32)
+    sign = np.where(words & 0x80000000, -1.0, 1.0)
+    exponent = ((words >> 24) & 0x7f).astype(np.int64) - 64
+    fraction = (words & 0xffffff) / float(1 << 24)
+    return sign * fraction * 16.0 ** exponent
+
+
+class GvarCalibration(Calibration):
+    """
+    GOES I-M imager raw counts to radiance (RAD) or albedo in percent (ALB, band 1)
+
+    The cal block is 41 IBM floating point words: visible bias, first and second order gain for each of the
+    8 visible detectors in turn (words 1-24), the radiance to albedo factor (25), then IR bias for bands 2-5 on
+    detector sides 1 and 2 (26-33) and IR gain likewise (34-41). Stored values are 10-bit counts scaled by 32.
+    The coefficients used are those of the given detector (1-8 visible, side 1 or 2 IR), otherwise their average
+    over detectors; calibrate() takes each line's detector.
+    Brightness temperature (TEMP) is refused: it needs each imager's band-correction coefficients, which the
+    cal block does not carry, and approximate values should not pass for McIDAS TEMP.
+    """
+    signed = False
+    # stored values are counts times this
+    COUNT_SCALE = 32.0
+    VIS_DETECTORS = 8
+    IR_BANDS = (2, 3, 4, 5)
+    CAL_WORDS = 41
+
+    def __init__(self, header, cal_block=None, band=None, detector=None):
+        super(GvarCalibration, self).__init__(header, cal_block, band, detector)
+        if cal_block is None or len(cal_block) < 4 * self.CAL_WORDS:
+            raise ValueError('GVAR calibration needs a cal block of %d words' % self.CAL_WORDS)
+        coef = gould_to_float(np.frombuffer(cal_block, dtype='>u4', count=self.CAL_WORDS))
+        n = self.VIS_DETECTORS
+        ir = 3 * n + 1
+        # (detector, ...) arrays: visible by detector, IR (side, band)
+        vis_bias, vis_gain1, vis_gain2 = coef[0:n], coef[n:2 * n], coef[2 * n:3 * n]
+        ir_bias, ir_gain = coef[ir:ir + 8].reshape(2, 4), coef[ir + 8:ir + 16].reshape(2, 4)
+        self.rad_to_albedo = coef[3 * n]
+        if detector is None:
+            self.vis_bias, self.vis_gain1, self.vis_gain2 = vis_bias.mean(), vis_gain1.mean(), vis_gain2.mean()
+            self.ir_bias, self.ir_gain = ir_bias.mean(axis=0), ir_gain.mean(axis=0)
+            return
+        detectors = n if band == 1 else 2
+        if not 1 <= detector <= detectors:
+            raise ValueError('GVAR band %r has detectors 1-%d, not %r' % (band, detectors, detector))
+        k = detector - 1
+        self.vis_bias, self.vis_gain1, self.vis_gain2 = vis_bias[k], vis_gain1[k], vis_gain2[k]
+        self.ir_bias, self.ir_gain = ir_bias[k], ir_gain[k]
+
+    def radiance(self, values):
+        counts = np.asarray(values, dtype=np.float64) / self.COUNT_SCALE
+        if self.band == 1:
+            return self.vis_bias + (self.vis_gain1 + self.vis_gain2 * counts) * counts
+        if self.band not in self.IR_BANDS:
+            raise ValueError('GVAR imager has no band %r' % (self.band, ))
+        k = self.IR_BANDS.index(self.band)
+        return (counts - self.ir_bias[k]) / self.ir_gain[k]
+
+    def convert(self, values, to_units):
+        rad = self.radiance(values)
+        if to_units == 'RAD':
+            return rad
+        if to_units == 'ALB' and self.band == 1:
+            return 100.0 * np.clip(rad * self.rad_to_albedo, 0.0, None)
+        if to_units == 'TEMP':
+            raise ValueError('GVAR brightness temperature needs band corrections the cal block does not carry; '
+                             'calibrate to RAD')
+        raise ValueError('cannot calibrate GVAR band %r to %s' % (self.band, to_units))
+
+
+# calibrations for raw counts, by the header's calibration type; register sensor-specific
+# Calibration subclasses that parse their cal block here
+CALIBRATIONS = {
+    'GVAR': GvarCalibration,
+}
+
+# calibrations by the units of the stored values, for anything not in raw counts
+UNIT_CALIBRATIONS = {
+    'BRIT': BritCalibration,
+}
+
+
+def calibration(header, cal_block=None, band=None, detector=None):
+    """
+    return the Calibration for an image with the given header, cal block, band and optionally detector
+    """
+    units = image_units(header)
+    cls = None
+    if units == 'RAW':
+        cal_type = header.cal_type.decode('ascii', 'replace').strip()
+        cls = CALIBRATIONS.get(cal_type)
+        if cls is None:
+            raise ValueError('no calibration registered for raw %r data' % cal_type)
+    cls = cls or UNIT_CALIBRATIONS.get(units, Calibration)
+    return cls(header, cal_block, band, detector)
+
+
+# lookup tables by (cal type, cal block hash, band, detector, units, scaling, bytes per element, target units)
+TABLE_CACHE = LRUCache(maxsize=64)
+
+
+def _cal_block(zult):
+    raw = getattr(zult, '_cal_raw', None)
+    return bytes(bytearray(raw)) if raw is not None else b''
+
+
+def calibration_table(zult, to_units, band=None, detector=None):
+    """
+    return the cached lookup table converting an AGET result's stored values to to_units
+    """
+    band = band if (band is not None) else (header_bands(zult) or [None])[0]
+    cal_block = _cal_block(zult)
+    key = (bytes(zult.cal_type), hashlib.sha1(cal_block).hexdigest(), band, detector, zult.units, zult.scaling,
+           zult.bytes_per_element, to_units)
+
+    def build():
+        table = calibration(zult, cal_block, band, detector).table(zult.bytes_per_element, to_units)
+        table.flags.writeable = False
+        return table
+
+    return TABLE_CACHE.get(key, build)
+
+
+def _calibrate_lines(zult, image, to_units, band, detector):
+    if zult.bytes_per_element == 4:
+        band = band if (band is not None) else (header_bands(zult) or [None])[0]
+        cal = calibration(zult, _cal_block(zult), band, detector)
+        return np.asarray(cal.convert(image.astype(np.int64), to_units), dtype=np.float32)
+    table = calibration_table(zult, to_units, band, detector)
+    # index by the unsigned bit pattern of each element, whatever its byte order
+    return table[image.view(image.dtype.str.replace('i', 'u'))]
+
+
+def calibrate(zult, to_units, band=None, detectors=None):
+    """
+    return an AGET result's image converted to to_units as a float32 array
+    :param band: band to convert, by default the first; the only one of a multi-band image that is converted
+    :param detectors: detector number of each image line, e.g. read from the line prefixes, for calibrations
+        with coefficients per detector such as GVAR; without it those are averaged over detectors
+    """
+    if zult.band_count > 1:
+        band = band if (band is not None) else zult.band_numbers[0]
+        image = zult.band_array(band)
+    else:
+        image = zult.image_array
+    if detectors is None:
+        return _calibrate_lines(zult, image, to_units, band, None)
+    detectors = np.asarray(detectors)
+    if detectors.shape != image.shape[:1]:
+        raise ValueError('need a detector number for each of the %d lines' % image.shape[0])
+    out = np.empty(image.shape, dtype=np.float32)
+    for detector in np.unique(detectors):
+        lines = detectors == detector
+        out[lines] = _calibrate_lines(zult, image[lines], to_units, band, int(detector))
+    return out
+
+
+class test_cal(unittest.TestCase):
+
+    def test_brit_temperature(self):
+        from pyadde.adde import adde_header_t
+        hdr = adde_header_t()
+        hdr.units = struct.unpack('>i', b'BRIT')[0]
+        brit = calibration(hdr)
+        table = brit.table(1, 'TEMP')
+        self.assertEqual(len(table), 256)
+        self.assertAlmostEqual(table[0], 330.0)
+        self.assertAlmostEqual(table[176], 242.0)
+        self.assertAlmostEqual(table[255], 163.0)
+
+    def test_gvar(self):
+        from pyadde.adde import adde_header_t
+        hdr = adde_header_t()
+        hdr.units = struct.unpack('>i', b'RAW ')[0]
+        hdr.cal_type = b'GVAR'
+        hdr.sensor_source_number = 70
+        # IBM floating point: -2.0, 0.5, 0.0, ~0.01; IR bias 100.0 on side 1 and 80.0 on side 2, gain 2.0
+        vis = [0xC1200000] * 8 + [0x40800000] * 8 + [0] * 8 + [0x3F28F5C3]
+        ir = [0x42640000] * 4 + [0x42500000] * 4 + [0x41200000] * 8
+        block = struct.pack('>41I', *(vis + ir)) + b'\0' * (128 * 4 - 41 * 4)
+        np.testing.assert_allclose(gould_to_float([0xC1200000, 0x3F28F5C3, 0x42640000]), [-2.0, 0.01, 100.0],
+                                   rtol=1e-6)
+        # visible count 100, stored as 3200: radiance -2 + 0.5 * 100
+        table = calibration(hdr, block, band=1).table(2, 'ALB')
+        self.assertAlmostEqual(table[3200], 48.0, places=4)
+        self.assertAlmostEqual(calibration(hdr, block, band=1).table(2, 'RAD')[3200], 48.0, places=4)
+        # IR band 4 count 300: radiance (300 - 100) / 2 on side 1, (300 - 80) / 2 on side 2
+        ir4 = calibration(hdr, block, band=4)
+        self.assertAlmostEqual(ir4.table(2, 'RAD')[300 * 32], 105.0, places=4)
+        sides = dict((detector, calibration(hdr, block, 4, detector).table(2, 'RAD')) for detector in (1, 2))
+        self.assertAlmostEqual(sides[1][300 * 32], 100.0, places=4)
+        self.assertAlmostEqual(sides[2][300 * 32], 110.0, places=4)
+        self.assertRaises(ValueError, calibration, hdr, block, 4, 3)
+        self.assertRaises(ValueError, ir4.table, 2, 'TEMP')
+        self.assertRaises(ValueError, calibration(hdr, block, band=1).table, 2, 'TEMP')
+        hdr.cal_type = b'MSAT'
+        self.assertRaises(ValueError, calibration, hdr, block, 1)
+
+        # a raw AGET payload with the same cal block, calibrated in one lookup
+        from pyadde.adde import map_aget
+        from pyadde.server import synthetic_area
+        payload = synthetic_area(lines=4, elements=5, bands=(4, ), cal=True)
+        h = adde_header_t.from_buffer(payload)
+        h.cal_type, h.units, h.sensor_source_number = b'GVAR', hdr.units, 70
+        payload[h.cal_block_offset:h.cal_block_offset + len(block)] = block
+        del h
+        zult = map_aget(payload)
+        rad = calibrate(zult, 'RAD')
+        self.assertEqual(rad.shape, (4, 5))
+        counts = zult.image_array.astype(np.int64)
+        np.testing.assert_array_equal(rad, ir4.table(2, 'RAD')[counts])
+        # lines alternating between the detector sides
+        rad = calibrate(zult, 'RAD', detectors=[1, 2, 1, 2])
+        for detector in (1, 2):
+            np.testing.assert_array_equal(rad[detector - 1::2], sides[detector][counts[detector - 1::2]])
+        self.assertRaises(ValueError, calibrate, zult, 'RAD', detectors=[1, 2])
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""metrics.py
+
+Per-request timing of ADDE transfers, split into phases, and a default aggregator of percentiles.
+
+A Session given an instrument, any callable taking a RequestTiming, calls it once per transfer:
+
+    timings = TimingAggregator()
+    ses = Session(host, port, user, project, password, instrument=timings)
+    ...
+    timings.summary()['transfer']['p95']
+
+Phases, in seconds: resolve (server and client addresses), connect (connection from the pool),
+ttfb (request sent until the first reply byte), transfer (first to last reply byte) and build
+(last byte until the result is ready, e.g. structure mapping). Sessions without an instrument
+skip all of this.
+
+Copyright (c) 2014 University of Wisconsin SSEC. All rights reserved.
+"""
+
+import logging
+import threading
+import time
+import unittest
+from collections import deque
+
+import numpy as np
+
+LOG = logging.getLogger(__name__)
+
+PHASES = ('resolve', 'connect', 'ttfb', 'transfer', 'build', 'total')
+PERCENTILES = (50, 95, 99)
+
+clock = time.perf_counter
+
+
+class RequestTiming(object):
+    """
+    phase timings of one request, in seconds, and the reply bytes received
+    error holds the exception of a failed request, whose later phases stay None
+    """
+    __slots__ = ('service', 'request', 'host', 'port', 'resolve', 'connect', 'ttfb', 'transfer', 'build', 'total',
+                 'nbytes', 'error')
+
+    def __init__(self, service, request, host, port):
+        self.service = service
+        self.request = request
+        self.host = host
+        self.port = port
+        self.resolve = self.connect = self.ttfb = self.transfer = self.build = self.total = None
+        self.nbytes = 0
+        self.error = None
+
+    @property
+    def throughput(self):
+        "reply bytes per second over the transfer phase"
+        return self.nbytes / self.transfer if self.transfer else None
+
+    def as_dict(self):
+        zult = dict((name, getattr(self, name)) for name in self.__slots__)
+        zult['error'] = None if self.error is None else repr(self.error)
+        zult['throughput'] = self.throughput
+        return zult
+
+
+class TimedSocket(object):
+    """
+    socket wrapper noting when the first and last reply bytes arrive and how many there were
+    everything other than recv and recv_into goes straight to the socket
+    """
+    first = None
+    last = None
+    nbytes = 0
+
+    def __init__(self, sock):
+        self._sock = sock
+
+    def _got(self, n):
+        now = clock()
+        if n and self.first is None:
+            self.first = now
+        self.last = now
+        self.nbytes += n
+
+    def recv_into(self, buffer, nbytes=0, *flags):
+        n = self._sock.recv_into(buffer, nbytes, *flags)
+        self._got(n)
+        return n
+
+    def recv(self, bufsize, *flags):
+        data = self._sock.recv(bufsize, *flags)
+        self._got(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+def _percentiles(values):
+    values = np.asarray(values, dtype=np.float64)
+    zult = dict(('p%d' % p, float(v)) for (p, v) in zip(PERCENTILES, np.percentile(values, PERCENTILES)))
+    zult.update(mean=float(values.mean()), count=len(values))
+    return zult
+
+
+class TimingAggregator(object):
+    """
+    instrument keeping the most recent window of RequestTimings and summarizing them as percentiles
+    """
+    window = None
+    requests = 0
+    errors = 0
+    nbytes = 0
+
+    def __init__(self, window=10000):
+        self.window = window
+        self._timings = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def __call__(self, timing):
+        with self._lock:
+            self.requests += 1
+            if timing.error is not None:
+                self.errors += 1
+            self.nbytes += timing.nbytes
+            self._timings.append(timing)
+
+    def summary(self):
+        """
+        return {phase: {p50, p95, p99, mean, count}} over the window, phases as in PHASES plus throughput
+        in bytes per second; failed requests count only in the phases they completed
+        """
+        with self._lock:
+            timings = list(self._timings)
+        zult = dict(requests=self.requests, errors=self.errors, nbytes=self.nbytes)
+        for name in PHASES + ('throughput', ):
+            values = [getattr(t, name) for t in timings]
+            values = [v for v in values if v is not None]
+            if values:
+                zult[name] = _percentiles(values)
+        return zult
+
+    def clear(self):
+        with self._lock:
+            self._timings.clear()
+            self.requests = self.errors = self.nbytes = 0
+
+
+class test_metrics(unittest.TestCase):
+
+    def test_session_phases(self):
+        from pyadde.adde import Session, TEST_REQ_STRING
+        from pyadde.pool import ConnectionPool
+        from pyadde.server import AddeServer, SyntheticSource
+        timings = TimingAggregator()
+        with AddeServer(SyntheticSource(), latency=0.05) as srv:
+            ses = Session('127.0.0.1', srv.port, 'RKG', 6999, '', pool=ConnectionPool(),
+                          instrument=timings)
+            for _ in range(3):
+                ses.aget(TEST_REQ_STRING)
+        summary = timings.summary()
+        self.assertEqual((summary['requests'], summary['errors']), (3, 0))
+        self.assertGreaterEqual(summary['ttfb']['p50'], 0.05)
+        self.assertEqual(summary['transfer']['count'], 3)
+        self.assertEqual(summary['nbytes'], 3 * (4 + 256 + 512 + 480 * 640 * 2 + 80))
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""nav.py
+
+Vectorized McIDAS navigation of AGET results: image line/element to latitude/longitude and back.
+
+Latitudes and longitudes are in degrees, longitude east-positive (McIDAS itself is west-positive).
+Points that do not navigate, e.g. space pixels, come back as NaN.
+
+RECT blocks are navigated exactly. Other types, e.g. GVAR and MSAT, are not supported and raise
+ValueError; GVAR blocks can be given the nominal fixed-grid approximation on request, see GvarNominalNav.
+http://www.ssec.wisc.edu/mcidas/doc/prog_man/current/formats-1.html
+
+Copyright (c) 2014 University of Wisconsin SSEC. All rights reserved.
+"""
+
+import hashlib
+import logging
+import struct
+import unittest
+
+import numpy as np
+
+from pyadde.adde import LRUCache
+
+LOG = logging.getLogger(__name__)
+
+# WGS84 ellipsoid and nominal geostationary orbit radius, km
+EARTH_EQUATORIAL_RADIUS = 6378.137
+EARTH_POLAR_RADIUS = 6356.7533
+GEO_RADIUS = 42164.365
+
+
+def _nav_words(nav_block):
+    "nav block as received (network order) to an int64 array of word values, word 1 at index 0"
+    raw = bytes(bytearray(nav_block))
+    return np.frombuffer(raw[:len(raw) - len(raw) % 4], dtype='>i4').astype(np.int64)
+
+
+def nav_type(nav_block):
+    "four-character navigation type held in the first word of the nav block, e.g. 'GVAR'"
+    return bytes(bytearray(nav_block))[:4].decode('ascii', 'replace')
+
+
+class Navigation(object):
+    """
+    base of the navigation types, constructed from the words of a nav block
+    subclasses transform arrays of image coordinates to earth coordinates and back
+    """
+    words = None
+
+    def __init__(self, words):
+        self.words = words
+
+    def image_to_earth(self, lines, elements):
+        "return (lat, lon) arrays for arrays of image lines and elements"
+        raise NotImplementedError()
+
+    def earth_to_image(self, lat, lon):
+        "return (line, element) arrays of image coordinates for arrays of latitude and longitude"
+        raise NotImplementedError()
+
+
+class RectNav(Navigation):
+    """
+    RECT: rectilinear latitude/longitude grid
+    words 2-7: reference line, its latitude*10000, reference element, its longitude*10000 (west positive),
+    degrees of latitude per line*10000, degrees of longitude per element*10000
+    """
+
+    def __init__(self, words):
+        super(RectNav, self).__init__(words)
+        self.ref_line = float(words[1])
+        self.ref_lat = words[2] / 10000.0
+        self.ref_element = float(words[3])
+        self.ref_lon_west = words[4] / 10000.0
+        self.lat_per_line = words[5] / 10000.0
+        self.lon_per_element = words[6] / 10000.0
+
+    def image_to_earth(self, lines, elements):
+        lines, elements = np.broadcast_arrays(np.asarray(lines, dtype=np.float64),
+                                              np.asarray(elements, dtype=np.float64))
+        lat = self.ref_lat + (self.ref_line - lines) * self.lat_per_line
+        lon_west = self.ref_lon_west + (self.ref_element - elements) * self.lon_per_element
+        lon = (180.0 - lon_west) % 360.0 - 180.0
+        lat = np.where(np.abs(lat) > 90.0, np.nan, lat)
+        lon = np.where(np.isnan(lat), np.nan, lon)
+        return lat, lon
+
+    def earth_to_image(self, lat, lon):
+        lat, lon = np.broadcast_arrays(np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64))
+        line = self.ref_line - (lat - self.ref_lat) / self.lat_per_line
+        # longitude offset from the reference, taken the short way around in the grid's direction
+        dlon_west = (-lon - self.ref_lon_west + 180.0) % 360.0 - 180.0
+        element = self.ref_element - dlon_west / self.lon_per_element
+        return line, element
+
+
+class GvarNominalNav(Navigation):
+    """
+    GVAR: GOES I-M imager or sounder, approximated by the nominal fixed-grid scan geometry
+
+    This is not the McIDAS gimloc model, so it is not used for GVAR blocks unless asked for,
+    e.g. navigation(block, nav_class=GvarNominalNav). Only the reference longitude (nav word 6,
+    radians*10**7) is read from the block; the satellite sits there on an ideal geostationary orbit
+    with ideal attitude, scan angles following the GOES instrument constants. The orbit, attitude and
+    misalignment terms in the rest of the block are ignored, so locations can be off by
+    several pixels, more when the spacecraft is far from nominal.
+    """
+    # per instrument (imager, sounder), radians
+    ELEVATION_PER_LINE = (28.0e-6, 280.0e-6)
+    SCAN_PER_PIXEL = (16.0e-6, 280.0e-6)
+    ELEVATION_MAX = (0.220896, 0.22089375)
+    SCAN_MAX = (0.245428, 0.2454375)
+
+    def __init__(self, words, instrument=1, sub_lon=None):
+        """
+        :param instrument: 1 for the imager, 2 for the sounder
+        :param sub_lon: sub-satellite longitude in degrees east, overriding the nav block
+        """
+        super(GvarNominalNav, self).__init__(words)
+        self.instrument = instrument
+        self.sub_lon = sub_lon if (sub_lon is not None) else np.degrees(words[5] / 1.0e7)
+        k = instrument - 1
+        self._elv_line = self.ELEVATION_PER_LINE[k]
+        self._scn_pixel = self.SCAN_PER_PIXEL[k]
+        self._elv_max = self.ELEVATION_MAX[k]
+        self._scn_max = self.SCAN_MAX[k]
+        lam = np.radians(self.sub_lon)
+        self._sat = GEO_RADIUS * np.array([np.cos(lam), np.sin(lam), 0.0])
+        self._east = np.array([-np.sin(lam), np.cos(lam), 0.0])
+        self._nadir = -self._sat / GEO_RADIUS
+
+    def image_to_earth(self, lines, elements):
+        lines, elements = np.broadcast_arrays(np.asarray(lines, dtype=np.float64),
+                                              np.asarray(elements, dtype=np.float64))
+        elev = self._elv_max - (lines - 4.5) * self._elv_line
+        scan = (elements - 1.0) * self._scn_pixel - self._scn_max
+        # line of sight in (east, north, nadir) components, then earth-fixed
+        u = np.sin(scan)
+        v = np.sin(elev) * np.cos(scan)
+        w = np.cos(elev) * np.cos(scan)
+        dx = u * self._east[0] + w * self._nadir[0]
+        dy = u * self._east[1] + w * self._nadir[1]
+        dz = v
+        # intersect with the ellipsoid
+        a2 = EARTH_EQUATORIAL_RADIUS ** 2
+        b2 = EARTH_POLAR_RADIUS ** 2
+        sx, sy = self._sat[0], self._sat[1]
+        qa = (dx * dx + dy * dy) / a2 + dz * dz / b2
+        qb = 2.0 * (sx * dx + sy * dy) / a2
+        qc = (sx * sx + sy * sy) / a2 - 1.0
+        disc = qb * qb - 4.0 * qa * qc
+        with np.errstate(invalid='ignore'):
+            t = (-qb - np.sqrt(disc)) / (2.0 * qa)
+        t = np.where(disc < 0.0, np.nan, t)
+        x = sx + t * dx
+        y = sy + t * dy
+        z = t * dz
+        lat = np.degrees(np.arctan2(z * a2 / b2, np.hypot(x, y)))
+        lon = np.degrees(np.arctan2(y, x))
+        return lat, lon
+
+    def earth_to_image(self, lat, lon):
+        lat, lon = np.broadcast_arrays(np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64))
+        a2 = EARTH_EQUATORIAL_RADIUS ** 2
+        b2 = EARTH_POLAR_RADIUS ** 2
+        phi_c = np.arctan(b2 / a2 * np.tan(np.radians(lat)))
+        lam = np.radians(lon)
+        e2 = 1.0 - b2 / a2
+        r = EARTH_POLAR_RADIUS / np.sqrt(1.0 - e2 * np.cos(phi_c) ** 2)
+        px = r * np.cos(phi_c) * np.cos(lam)
+        py = r * np.cos(phi_c) * np.sin(lam)
+        pz = r * np.sin(phi_c)
+        vx, vy, vz = px - self._sat[0], py - self._sat[1], pz
+        # hidden when the line of sight meets the surface from below its tangent plane
+        visible = (vx * px / a2 + vy * py / a2 + vz * pz / b2) < 0.0
+        norm = np.sqrt(vx * vx + vy * vy + vz * vz)
+        u = (vx * self._east[0] + vy * self._east[1]) / norm
+        v = vz / norm
+        w = (vx * self._nadir[0] + vy * self._nadir[1]) / norm
+        scan = np.arcsin(u)
+        elev = np.arctan2(v, w)
+        line = (self._elv_max - elev) / self._elv_line + 4.5
+        element = (scan + self._scn_max) / self._scn_pixel + 1.0
+        return np.where(visible, line, np.nan), np.where(visible, element, np.nan)
+
+
+# navigation classes by nav block type; GVAR, MSAT and other types have none
+NAV_TYPES = {
+    'RECT': RectNav,
+}
+
+# approximations of unsupported types, used only when passed as nav_class
+APPROXIMATE_NAV_TYPES = {
+    'GVAR': GvarNominalNav,
+}
+
+
+def navigation(nav_block, nav_class=None, **kwargs):
+    """
+    return a Navigation for a nav block as received over ADDE, e.g. the _nav_raw field of an AGET result
+    keyword arguments are passed to the navigation class
+    :param nav_class: Navigation subclass to use whatever the block's type, e.g. GvarNominalNav
+    """
+    typ = nav_type(nav_block)
+    cls = nav_class or NAV_TYPES.get(typ)
+    if cls is None:
+        approximate = APPROXIMATE_NAV_TYPES.get(typ)
+        if approximate is not None:
+            raise ValueError('navigation type %r is not supported; pass nav_class=%s for an approximation' % (
+                typ, approximate.__name__))
+        raise ValueError('navigation type %r is not supported' % typ)
+    return cls(_nav_words(nav_block), **kwargs)
+
+
+def area_to_image(header, rows, columns):
+    "image coordinates of area rows and columns, per the header's upper-left corner and resolution"
+    return (header.line_ul + np.asarray(rows) * header.line_res,
+            header.element_ul + np.asarray(columns) * header.element_res)
+
+
+def image_to_area(header, lines, elements):
+    "area rows and columns of image coordinates, fractional where they fall between pixels"
+    return ((np.asarray(lines, dtype=np.float64) - header.line_ul) / header.line_res,
+            (np.asarray(elements, dtype=np.float64) - header.element_ul) / header.element_res)
+
+
+# lat/lon grids, which are large: keep only a few
+GRID_CACHE = LRUCache(maxsize=8)
+
+
+def latlon_grid(zult, **kwargs):
+    """
+    return (lat, lon) arrays with the shape of an AGET result's image, one value per pixel
+    keyword arguments are passed to navigation(), e.g. nav_class=GvarNominalNav;
+    grids are cached by nav block hash, area geometry and those arguments, and returned read-only
+    """
+    nav_block = bytes(bytearray(zult._nav_raw))
+    key = (hashlib.sha1(nav_block).hexdigest(), zult.line_ul, zult.element_ul, zult.line_res,
+           zult.element_res, zult.lines, zult.elements, tuple(sorted(kwargs.items())))
+
+    def build():
+        lines, elements = area_to_image(zult, np.arange(zult.lines)[:, None], np.arange(zult.elements)[None, :])
+        lat, lon = navigation(nav_block, **kwargs).image_to_earth(lines, elements)
+        lat.flags.writeable = False
+        lon.flags.writeable = False
+        return lat, lon
+
+    return GRID_CACHE.get(key, build)
+
+
+class test_nav(unittest.TestCase):
+
+    def test_rect_round_trip(self):
+        block = b'RECT' + struct.pack('!6i', 100, 450000, 200, 900000, 2500, 2500) + b'\0' * 100
+        rect = navigation(block)
+        lat, lon = rect.image_to_earth([100, 0], [200, 0])
+        np.testing.assert_allclose(lat, [45.0, 70.0])
+        np.testing.assert_allclose(lon, [-90.0, -140.0])
+        line, element = rect.earth_to_image(lat, lon)
+        np.testing.assert_allclose(line, [100, 0])
+        np.testing.assert_allclose(element, [200, 0])
+
+    def test_gvar_round_trip(self):
+        words = np.zeros(640, dtype=np.int64)
+        words[5] = int(np.radians(-75.0) * 1.0e7)
+        gvar = GvarNominalNav(words)
+        lines, elements = np.meshgrid(np.arange(3000.0, 13000.0, 500.0), np.arange(4000.0, 27000.0, 1000.0),
+                                      indexing='ij')
+        lat, lon = gvar.image_to_earth(lines, elements)
+        back_lines, back_elements = gvar.earth_to_image(lat, lon)
+        ok = ~np.isnan(lat)
+        self.assertTrue(ok.any())
+        np.testing.assert_allclose(back_lines[ok], lines[ok], atol=1e-6)
+        np.testing.assert_allclose(back_elements[ok], elements[ok], atol=1e-6)
+
+    def test_gvar_fixed_grid(self):
+        # pairs worked out by hand from the fixed-grid geometry, not by the model's own inverse
+        block = b'GVAR' + struct.pack('!5i', 0, 0, 0, 0, int(round(np.radians(-75.0) * 1.0e7))) + b'\0' * 2536
+        self.assertRaises(ValueError, navigation, block)
+        gvar = navigation(block, nav_class=GvarNominalNav)
+        # scan and elevation are zero at the sub-satellite point
+        nadir_line, nadir_element = 0.220896 / 28.0e-6 + 4.5, 0.245428 / 16.0e-6 + 1.0
+        # on the equator 30 degrees east of it, seen at scan angle atan(a sin 30 / (r - a cos 30))
+        a = EARTH_EQUATORIAL_RADIUS
+        scan = np.arctan(a * np.sin(np.radians(30.0)) / (GEO_RADIUS - a * np.cos(np.radians(30.0))))
+        # on the sub-satellite meridian at geodetic latitude 40, seen at elevation atan(z / (r - x))
+        phi_c = np.arctan((EARTH_POLAR_RADIUS / a) ** 2 * np.tan(np.radians(40.0)))
+        radius = EARTH_POLAR_RADIUS / np.sqrt(1.0 - (1.0 - (EARTH_POLAR_RADIUS / a) ** 2) * np.cos(phi_c) ** 2)
+        elev = np.arctan(radius * np.sin(phi_c) / (GEO_RADIUS - radius * np.cos(phi_c)))
+        lines = [nadir_line, nadir_line, nadir_line - elev / 28.0e-6]
+        elements = [nadir_element, nadir_element + scan / 16.0e-6, nadir_element]
+        lat, lon = gvar.image_to_earth(lines, elements)
+        np.testing.assert_allclose(lat, [0.0, 0.0, 40.0], atol=1e-6)
+        np.testing.assert_allclose(lon, [-75.0, -45.0, -75.0], atol=1e-6)
+        line, element = gvar.earth_to_image([0.0, 0.0, 40.0], [-75.0, -45.0, -75.0])
+        np.testing.assert_allclose(line, lines, atol=1e-4)
+        np.testing.assert_allclose(element, elements, atol=1e-4)
+        # past the limb, at scan angle asin(a / r), is space
+        limb = np.arcsin(a / GEO_RADIUS) / 16.0e-6
+        self.assertTrue(np.isnan(gvar.image_to_earth(nadir_line, nadir_element + limb + 10.0)[0]))
+
+    def test_unsupported(self):
+        self.assertRaises(ValueError, navigation, b'MSAT' + b'\0' * 508)
@@ -0,0 +1,436 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""pool.py
+
+Shared connection and name-resolution caches for ADDE sessions.
+
+Copyright (c) 2014 University of Wisconsin SSEC. All rights reserved.
+"""
+
+import errno
+import logging
+import selectors
+import socket
+import threading
+import time
+import unittest
+import weakref
+
+LOG = logging.getLogger(__name__)
+
+# seconds a pre-warming connect may hold up the recycler thread
+PREWARM_TIMEOUT = 2.0
+
+
+class ResolverCache(object):
+    """
+    cache of host name to IPv4 address lookups, each entry living for ttl seconds
+    """
+    ttl = None
+    hits = 0
+    misses = 0
+
+    def __init__(self, ttl=300.0):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _lookup(host):
+        # same resolution rule Session has always used: first address of gethostbyaddr
+        return list(socket.gethostbyaddr(host))[2][0]
+
+    def address(self, host):
+        """
+        return dotted-quad address string for host, consulting the cache first
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(host)
+            if entry is not None and entry[1] > now:
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        addr = self._lookup(host)
+        with self._lock:
+            self._entries[host] = (addr, now + self.ttl)
+        return addr
+
+    def local_address(self):
+        "address of this client machine as the server will see it"
+        return self.address(socket.gethostname())
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, entries=len(self._entries))
+
+
+def _is_reusable(sock):
+    """
+    peek at an idle socket without blocking; it is only reusable if the peer has neither
+    closed it nor left unread bytes (e.g. a trailer) in it
+    """
+    timeout = sock.gettimeout()
+    try:
+        sock.setblocking(False)
+        try:
+            sock.recv(1, socket.MSG_PEEK)
+        except socket.error as err:
+            return err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK)
+        # b'' means an orderly shutdown from the server, anything else is stale data
+        return False
+    finally:
+        try:
+            sock.settimeout(timeout)
+        except socket.error:
+            pass
+
+
+class ConnectionPool(object):
+    """
+    pool of idle TCP connections to ADDE servers, keyed by (host, port)
+
+    Sockets handed back with release() are kept for reuse when the server leaves them open.
+    Whether the server is closing is decided off the caller's thread, by one recycler thread per pool
+    that watches every released socket at once for up to linger seconds for its FIN, and exits after
+    idle_timeout without releases. Idle sockets older than idle_timeout are dropped rather than handed out.
+
+    Most ADDE servers close after each transaction. With prewarm=True, the pool opens a fresh
+    connection in the background whenever one is closed, so the next request does not pay for
+    the TCP handshake. That costs the server an extra connection per request, and pays off only
+    when requests follow each other within idle_timeout; pollers should set idle_timeout a little
+    longer than their polling interval. Pre-warming is off by default.
+    """
+    max_idle = None
+    idle_timeout = None
+    prewarm = None
+    linger = None
+    hits = 0
+    misses = 0
+    prewarmed = 0
+    discarded = 0
+
+    def __init__(self, max_idle=4, idle_timeout=15.0, prewarm=False, linger=0.25):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.prewarm = prewarm
+        self.linger = linger
+        self._idle = {}  # (host, port) -> [(socket, time_parked), ...]
+        self._lingering = []  # [(socket, (host, port), linger_deadline), ...] released, not yet settled
+        self._reused = weakref.WeakSet()  # sockets acquire() handed out from the idle set
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+        self._recycler = None
+
+    @staticmethod
+    def _open(host, port, timeout=None):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.settimeout(timeout)
+        s.connect((host, port))
+        return s
+
+    def _park(self, key, sock):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append((sock, time.time()))
+                return True
+        return False
+
+    def _prewarm(self, key):
+        try:
+            s = self._open(key[0], key[1], PREWARM_TIMEOUT)
+        except socket.error as err:
+            LOG.debug('could not pre-warm connection to %s:%d: %s' % (key[0], key[1], err))
+            return
+        if self._park(key, s):
+            with self._lock:
+                self.prewarmed += 1
+        else:
+            s.close()
+
+    def acquire(self, host, port, timeout=None, fresh=False):
+        """
+        return a connected socket to host:port, from the idle set if a live one is available
+        :param fresh: open a new connection, e.g. to retry a request that failed on a reused one
+        """
+        key = (host, port)
+        oldest = time.time() - self.idle_timeout
+        while not fresh:
+            with self._lock:
+                idle = self._idle.get(key)
+                if not idle:
+                    self.misses += 1
+                    break
+                s, when = idle.pop()
+            if when >= oldest and _is_reusable(s):
+                with self._lock:
+                    self.hits += 1
+                    self._reused.add(s)
+                s.settimeout(timeout)
+                return s
+            with self._lock:
+                self.discarded += 1
+            s.close()
+        return self._open(host, port, timeout)
+
+    def was_reused(self, sock):
+        "whether acquire() handed out sock from the idle set rather than newly connected"
+        with self._lock:
+            return sock in self._reused
+
+    def _settle(self, sock, key):
+        "park a released socket its server left open, or close it"
+        try:
+            reusable = _is_reusable(sock)
+        except socket.error:
+            reusable = False
+        if reusable and self._park(key, sock):
+            return
+        sock.close()
+        with self._lock:
+            self.discarded += 1
+        if self.prewarm:
+            self._prewarm(key)
+
+    def _recycle(self):
+        "recycler thread: settle each released socket once its server closes it or its linger time is up"
+        while True:
+            with self._lock:
+                while not self._lingering:
+                    if not self._released.wait(self.idle_timeout) and not self._lingering:
+                        self._recycler = None
+                        return
+                lingering = list(self._lingering)
+            wait = min(deadline for _, _, deadline in lingering) - time.time()
+            closing = set()
+            with selectors.DefaultSelector() as sel:
+                for sock, _, _ in lingering:
+                    try:
+                        sel.register(sock, selectors.EVENT_READ)
+                    except (ValueError, KeyError, socket.error):
+                        # closed meanwhile
+                        closing.add(sock)
+                if sel.get_map():
+                    closing.update(key.fileobj for key, _ in sel.select(max(0.0, wait)))
+            now = time.time()
+            with self._lock:
+                # close() may have taken some away meanwhile
+                settled = [entry for entry in lingering
+                           if (entry[0] in closing or entry[2] <= now) and entry in self._lingering]
+                for entry in settled:
+                    self._lingering.remove(entry)
+            for sock, key, _ in settled:
+                self._settle(sock, key)
+
+    def release(self, sock, host, port):
+        """
+        hand a socket back after a completed transaction
+        """
+        with self._lock:
+            self._lingering.append((sock, (host, port), time.time() + self.linger))
+            if self._recycler is None:
+                self._recycler = threading.Thread(target=self._recycle, name='pyadde-pool-recycler')
+                self._recycler.daemon = True
+                self._recycler.start()
+            self._released.notify()
+
+    def discard(self, sock):
+        "close a socket that failed mid-transaction instead of returning it to the pool"
+        sock.close()
+        with self._lock:
+            self.discarded += 1
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+            lingering, self._lingering = self._lingering, []
+        for conns in idle.values():
+            for s, _ in conns:
+                s.close()
+        for s, _, _ in lingering:
+            s.close()
+
+    def stats(self):
+        with self._lock:
+            idle = sum(len(v) for v in self._idle.values())
+        return dict(hits=self.hits, misses=self.misses, prewarmed=self.prewarmed,
+                    discarded=self.discarded, idle=idle)
+
+
+class BufferPool(object):
+    """
+    size-classed pool of receive buffers, so repeated fetches of similar size reuse memory
+
+    Requests are rounded up to a size class (within 1/8 of the request above 4 KiB) and served
+    from that class's free list when possible. Released buffers are kept only while the total
+    pooled bytes stay under max_bytes; beyond that they are left to the garbage collector.
+    """
+    max_bytes = None
+    hits = 0
+    misses = 0
+    pooled_bytes = 0
+
+    def __init__(self, max_bytes=1 << 30):
+        self.max_bytes = max_bytes
+        self._free = {}  # size class -> [bytearray, ...]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def size_class(nbytes):
+        if nbytes <= 4096:
+            return 4096
+        step = 1 << max(0, nbytes.bit_length() - 4)
+        return ((nbytes + step - 1) // step) * step
+
+    def acquire(self, nbytes):
+        """
+        return a bytearray of at least nbytes, whose contents are undefined
+        """
+        size = self.size_class(nbytes)
+        with self._lock:
+            free = self._free.get(size)
+            if free:
+                self.hits += 1
+                self.pooled_bytes -= size
+                return free.pop()
+            self.misses += 1
+        return bytearray(size)
+
+    def release(self, buf):
+        """
+        return a buffer obtained from acquire(); nothing may use its contents afterwards
+        """
+        size = len(buf)
+        with self._lock:
+            if size != self.size_class(size) or self.pooled_bytes + size > self.max_bytes:
+                return
+            self._free.setdefault(size, []).append(buf)
+            self.pooled_bytes += size
+
+    def clear(self):
+        with self._lock:
+            self._free.clear()
+            self.pooled_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            count = sum(len(v) for v in self._free.values())
+        return dict(hits=self.hits, misses=self.misses, pooled_bytes=self.pooled_bytes,
+                    pooled_buffers=count, max_bytes=self.max_bytes)
+
+
+# shared by every Session unless one is given its own
+DEFAULT_RESOLVER = ResolverCache()
+DEFAULT_POOL = ConnectionPool()
+
+
+class test_pool(unittest.TestCase):
+
+    def serve(self, keep_alive):
+        "local server answering each b'?' with b'!', closing after the reply unless keep_alive"
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(32)
+        self.addCleanup(listener.close)
+
+        def handle(conn):
+            with conn:
+                while conn.recv(1):
+                    conn.sendall(b'!')
+                    if not keep_alive:
+                        return
+
+        def accept():
+            while True:
+                try:
+                    conn, _ = listener.accept()
+                except socket.error:
+                    return
+                t = threading.Thread(target=handle, args=(conn, ))
+                t.daemon = True
+                t.start()
+        t = threading.Thread(target=accept)
+        t.daemon = True
+        t.start()
+        return listener.getsockname()
+
+    def transact(self, pool, host, port):
+        s = pool.acquire(host, port, timeout=5.0)
+        s.sendall(b'?')
+        self.assertEqual(s.recv(1), b'!')
+        pool.release(s, host, port)
+        return s
+
+    def settle(self, pool, **expected):
+        "wait for the recycling threads to bring the pool counters to expected"
+        deadline = time.time() + 5.0
+        while time.time() < deadline:
+            stats = pool.stats()
+            if all(stats[k] == v for (k, v) in expected.items()):
+                return stats
+            time.sleep(0.01)
+        self.fail('pool stats %r never reached %r' % (pool.stats(), expected))
+
+    def test_keep_alive(self):
+        host, port = self.serve(keep_alive=True)
+        pool = ConnectionPool(linger=0.05)
+        first = self.transact(pool, host, port)
+        self.settle(pool, idle=1)
+        self.assertIs(self.transact(pool, host, port), first)
+        self.settle(pool, hits=1, misses=1, discarded=0, prewarmed=0, idle=1)
+        pool.close()
+
+    def test_closing_server(self):
+        host, port = self.serve(keep_alive=False)
+        pool = ConnectionPool(linger=0.05)
+        for _ in range(3):
+            self.transact(pool, host, port)
+            self.settle(pool, idle=0, discarded=pool.misses)
+        self.settle(pool, hits=0, misses=3, discarded=3, prewarmed=0, idle=0)
+
+    def test_recycler(self):
+        recyclers = lambda: sum(t.name == 'pyadde-pool-recycler' for t in threading.enumerate())
+        before = recyclers()
+        host, port = self.serve(keep_alive=True)
+        pool = ConnectionPool(linger=0.2)
+        socks = [pool.acquire(host, port, timeout=5.0) for _ in range(20)]
+        for s in socks:
+            s.sendall(b'?')
+            self.assertEqual(s.recv(1), b'!')
+            pool.release(s, host, port)
+        # one thread watches all twenty
+        self.assertEqual(recyclers(), before + 1)
+        self.settle(pool, misses=20, idle=4, discarded=16)
+        pool.close()
+        # sockets the server closes are settled on its FIN, without waiting out the linger time
+        host, port = self.serve(keep_alive=False)
+        pool = ConnectionPool(linger=30.0)
+        start = time.time()
+        for _ in range(5):
+            self.transact(pool, host, port)
+        self.settle(pool, discarded=5, idle=0)
+        self.assertLess(time.time() - start, 5.0)
+        pool.close()
+
+    def test_prewarm(self):
+        host, port = self.serve(keep_alive=False)
+        pool = ConnectionPool(linger=0.05, prewarm=True)
+        self.transact(pool, host, port)
+        self.settle(pool, discarded=1, prewarmed=1, idle=1)
+        self.transact(pool, host, port)
+        self.settle(pool, hits=1, misses=1, discarded=2, prewarmed=2, idle=1)
+        pool.close()
+
+    def test_idle_timeout(self):
+        host, port = self.serve(keep_alive=True)
+        pool = ConnectionPool(linger=0.05, idle_timeout=0.1)
+        self.transact(pool, host, port)
+        self.settle(pool, idle=1)
+        time.sleep(0.15)
+        self.transact(pool, host, port)
+        self.settle(pool, hits=0, misses=2, discarded=1)
+        pool.close()
@@ -0,0 +1,454 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""scheduler.py
+
+Per-server request scheduling in front of Session.aget and AsyncSession.aget: concurrency caps,
+priorities with ageing, and deadlines.
+
+Requests wait in one priority queue per (host, port) and at most the server's cap run at once.
+A lower priority number runs sooner. Waiting requests age: every `aging` seconds spent queued
+counts as one priority level, so backfill cannot be starved indefinitely by a stream of urgent work.
+A request not started by its deadline fails with DeadlineExceeded instead of running late.
+
+e.g.
+    sched = Scheduler(per_host=2)
+    urgent = sched.submit(ses, req, priority=0, deadline=30)
+    backfill = [sched.submit(ses, r, priority=10) for r in old_requests]
+    urgent.result()
+
+Copyright (c) 2014 University of Wisconsin SSEC. All rights reserved.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+import unittest
+from collections import deque
+from concurrent.futures import Future
+
+from pyadde.metrics import _percentiles
+
+LOG = logging.getLogger(__name__)
+
+
+class DeadlineExceeded(Exception):
+    "a scheduled request was still queued when its deadline passed"
+
+
+class _HostQueue(object):
+    """
+    waiting requests and counters for one server
+
+    Ageing lowers a request's effective priority by waited/aging; since every queued request ages at
+    the same rate, ordering by priority + submitted/aging gives the same order at any moment,
+    and a plain heap keeps it.
+    """
+    cap = None
+    running = 0
+    max_depth = 0
+    completed = 0
+    failed = 0
+    expired = 0
+
+    def __init__(self, cap, window):
+        self.cap = cap
+        self.heap = []
+        self.waits = deque(maxlen=window)
+
+    def push(self, rank, seq, item):
+        heapq.heappush(self.heap, (rank, seq, item))
+        self.max_depth = max(self.max_depth, len(self.heap))
+
+    def pop(self):
+        job = heapq.heappop(self.heap)[2]
+        job.queued = False
+        return job
+
+    def remove(self, job):
+        "take a job out of the queue before its turn"
+        self.heap = [entry for entry in self.heap if entry[2] is not job]
+        heapq.heapify(self.heap)
+        job.queued = False
+
+    def stats(self):
+        zult = dict(cap=self.cap, depth=len(self.heap), running=self.running, max_depth=self.max_depth,
+                    completed=self.completed, failed=self.failed, expired=self.expired)
+        if self.waits:
+            zult['wait'] = _percentiles(list(self.waits))
+        return zult
+
+
+class _Job(object):
+    "one queued call and the future for its outcome"
+    __slots__ = ('fn', 'future', 'submitted', 'deadline', 'key', 'queued', 'timer')
+
+    def __init__(self, fn, future, submitted, deadline, key):
+        self.fn = fn
+        self.future = future
+        self.submitted = submitted
+        self.deadline = deadline
+        self.key = key
+        self.queued = True
+        self.timer = None
+
+
+def _deadline_error(job, now):
+    return DeadlineExceeded('request waited %.1fs, past its deadline' % (now - job.submitted))
+
+
+class _Queues(object):
+    "per-(host, port) queues shared by the thread and asyncio schedulers"
+    per_host = None
+    aging = None
+
+    def __init__(self, per_host=4, caps=None, aging=10.0, window=10000):
+        """
+        :param per_host: concurrent requests allowed per server
+        :param caps: optional {(host, port): limit} overriding per_host for particular servers
+        :param aging: seconds of queueing worth one priority level; None disables ageing
+        :param window: number of recent queue waits kept per server for the statistics
+        """
+        self.per_host = per_host
+        self.caps = dict(caps or {})
+        self.aging = aging
+        self._window = window
+        self._queues = {}
+        self._seq = itertools.count()
+
+    def _queue(self, key):
+        q = self._queues.get(key)
+        if q is None:
+            q = self._queues[key] = _HostQueue(self.caps.get(key, self.per_host), self._window)
+        return q
+
+    def _rank(self, priority, submitted):
+        return priority + (submitted / self.aging if self.aging else 0.0)
+
+    def stats(self):
+        "{(host, port): {cap, depth, running, max_depth, completed, failed, expired, wait}}, wait in seconds"
+        return dict((key, q.stats()) for (key, q) in list(self._queues.items()))
+
+
+class Scheduler(_Queues):
+    """
+    thread-based scheduler returning concurrent.futures.Future objects
+    each server gets up to its cap of worker threads, started as work arrives for it;
+    one more thread fails queued requests as their deadlines pass, whether or not a slot has freed
+    """
+
+    def __init__(self, per_host=4, caps=None, aging=10.0, window=10000):
+        super(Scheduler, self).__init__(per_host, caps, aging, window)
+        self._cond = threading.Condition()
+        self._workers = {}
+        self._deadlines = []  # heap of (deadline, seq, job)
+        self._reaper = None
+        self._closed = False
+
+    def submit_call(self, host, port, fn, priority=0, deadline=None):
+        """
+        queue fn() to run against server host:port
+        :param priority: lower runs sooner
+        :param deadline: seconds from now by which fn must have started, else its future fails with DeadlineExceeded
+        :return: Future for fn's outcome
+        """
+        now = time.time()
+        future = Future()
+        key = (host, port)
+        job = _Job(fn, future, now, now + deadline if deadline is not None else None, key)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('scheduler has been shut down')
+            q = self._queue(key)
+            seq = next(self._seq)
+            q.push(self._rank(priority, now), seq, job)
+            if job.deadline is not None:
+                heapq.heappush(self._deadlines, (job.deadline, seq, job))
+                if self._reaper is None:
+                    self._reaper = threading.Thread(target=self._reap)
+                    self._reaper.daemon = True
+                    self._reaper.start()
+            workers = self._workers.setdefault(key, [])
+            if len(workers) < q.cap and len(workers) < q.running + len(q.heap):
+                t = threading.Thread(target=self._work, args=(key, ))
+                t.daemon = True
+                workers.append(t)
+                t.start()
+            self._cond.notify_all()
+        return future
+
+    def submit(self, session, request_string, priority=0, deadline=None, timeout=None):
+        "queue session.aget(request_string), see submit_call"
+        return self.submit_call(session.host, session.port, lambda: session.aget(request_string, timeout),
+                                priority, deadline)
+
+    def _reap(self):
+        "fail queued jobs as their deadlines pass"
+        with self._cond:
+            while True:
+                if self._closed:
+                    # jobs already started no longer need watching, so shutdown need not wait for their deadlines
+                    self._deadlines = [entry for entry in self._deadlines if entry[2].queued]
+                    heapq.heapify(self._deadlines)
+                while self._deadlines and not self._deadlines[0][2].queued:
+                    heapq.heappop(self._deadlines)
+                if not self._deadlines:
+                    if self._closed:
+                        return
+                    self._cond.wait()
+                    continue
+                now = time.time()
+                when, _, job = self._deadlines[0]
+                if when > now:
+                    self._cond.wait(when - now)
+                    continue
+                heapq.heappop(self._deadlines)
+                q = self._queues[job.key]
+                q.remove(job)
+                q.expired += 1
+                if job.future.set_running_or_notify_cancel():
+                    job.future.set_exception(_deadline_error(job, now))
+
+    def _next(self, key):
+        "wait for the next job for key that should run, None once shut down"
+        with self._cond:
+            q = self._queues[key]
+            while True:
+                while not q.heap and not self._closed:
+                    self._cond.wait()
+                if not q.heap:
+                    return None
+                job = q.pop()
+                if not job.future.set_running_or_notify_cancel():
+                    continue
+                now = time.time()
+                q.waits.append(now - job.submitted)
+                q.running += 1
+                return job
+
+    def _work(self, key):
+        q = self._queues[key]
+        while True:
+            job = self._next(key)
+            if job is None:
+                return
+            try:
+                result = job.fn()
+            except Exception as err:
+                with self._cond:
+                    q.running -= 1
+                    q.failed += 1
+                job.future.set_exception(err)
+            else:
+                with self._cond:
+                    q.running -= 1
+                    q.completed += 1
+                job.future.set_result(result)
+
+    def shutdown(self, wait=True, cancel_pending=False):
+        """
+        stop accepting work; queued jobs still run unless cancel_pending
+        """
+        with self._cond:
+            self._closed = True
+            if cancel_pending:
+                for q in self._queues.values():
+                    while q.heap:
+                        q.pop().future.cancel()
+            self._cond.notify_all()
+            workers = [t for ts in self._workers.values() for t in ts]
+            if self._reaper is not None:
+                workers.append(self._reaper)
+        if wait:
+            for t in workers:
+                t.join()
+
+
+class AsyncScheduler(_Queues):
+    """
+    asyncio scheduler for AsyncSession, with the same caps, priorities, ageing and deadlines as Scheduler
+    coroutines wait their turn in the server's queue and then run in the caller's task
+    An AsyncSession's own HostLimiter still applies underneath.
+    """
+
+    def _expire(self, q, job):
+        "event loop timer: fail a job still queued at its deadline"
+        if job.queued and not job.future.done():
+            q.remove(job)
+            q.expired += 1
+            job.future.set_exception(_deadline_error(job, time.time()))
+
+    def _release(self, q):
+        "hand the slot just freed to the best waiter that is still wanted"
+        q.running -= 1
+        while q.heap and q.running < q.cap:
+            job = q.pop()
+            if job.timer is not None:
+                job.timer.cancel()
+            if job.future.done():
+                continue
+            q.waits.append(time.time() - job.submitted)
+            q.running += 1
+            job.future.set_result(None)
+
+    async def run(self, host, port, coro_fn, priority=0, deadline=None):
+        """
+        await coro_fn() once server host:port has a free slot
+        :param priority: lower runs sooner
+        :param deadline: seconds from now by which coro_fn must have started, else DeadlineExceeded is raised
+        """
+        q = self._queue((host, port))
+        now = time.time()
+        if q.running < q.cap and not q.heap:
+            q.running += 1
+            q.waits.append(0.0)
+        else:
+            loop = asyncio.get_running_loop()
+            turn = loop.create_future()
+            job = _Job(coro_fn, turn, now, now + deadline if deadline is not None else None, (host, port))
+            q.push(self._rank(priority, now), next(self._seq), job)
+            if deadline is not None:
+                job.timer = loop.call_later(deadline, self._expire, q, job)
+            try:
+                await turn
+            except asyncio.CancelledError:
+                if job.timer is not None:
+                    job.timer.cancel()
+                if job.queued:
+                    q.remove(job)
+                elif turn.done() and not turn.cancelled() and turn.exception() is None:
+                    # the slot was handed over just as the caller gave up
+                    self._release(q)
+                raise
+        try:
+            result = await coro_fn()
+        except Exception:
+            q.failed += 1
+            raise
+        finally:
+            self._release(q)
+        q.completed += 1
+        return result
+
+    async def aget(self, session, request_string, priority=0, deadline=None, timeout=None):
+        "AsyncSession.aget(request_string) run in its server's turn, see run"
+        return await self.run(session.host, session.port, lambda: session.aget(request_string, timeout),
+                              priority, deadline)
+
+
+class test_scheduler(unittest.TestCase):
+
+    def blocked(self, sched, key=('adde', 112)):
+        "occupy key's only slot until the returned event is set"
+        started, gate = threading.Event(), threading.Event()
+        sched.submit_call(key[0], key[1], lambda: started.set() or gate.wait())
+        started.wait(5)
+        self.addCleanup(gate.set)
+        return gate
+
+    def test_priority(self):
+        sched = Scheduler(per_host=1, aging=None)
+        order = []
+        gate = self.blocked(sched)
+        for k in range(5):
+            sched.submit_call('adde', 112, lambda k=k: order.append(('backfill', k)), priority=10)
+        urgent = sched.submit_call('adde', 112, lambda: order.append(('urgent', 0)), priority=0)
+        stats = sched.stats()[('adde', 112)]
+        self.assertEqual((stats['depth'], stats['running'], stats['max_depth']), (6, 1, 6))
+        gate.set()
+        urgent.result(5)
+        sched.shutdown()
+        self.assertEqual(order, [('urgent', 0)] + [('backfill', k) for k in range(5)])
+        stats = sched.stats()[('adde', 112)]
+        self.assertEqual((stats['completed'], stats['depth'], stats['wait']['count']), (7, 0, 7))
+
+    def test_deadline_while_blocked(self):
+        sched = Scheduler(per_host=1)
+        self.blocked(sched)
+        start = time.time()
+        late = sched.submit_call('adde', 112, lambda: None, deadline=0.1)
+        # fails at its deadline although the slot it waits for is still taken
+        self.assertRaises(DeadlineExceeded, late.result, 2)
+        self.assertLess(time.time() - start, 1.0)
+        stats = sched.stats()[('adde', 112)]
+        self.assertEqual((stats['expired'], stats['depth'], stats['running']), (1, 0, 1))
+
+    def test_aging(self):
+        sched = Scheduler(per_host=1, aging=0.05)
+        order = []
+        gate = self.blocked(sched)
+        backfill = sched.submit_call('adde', 112, lambda: order.append('backfill'), priority=10)
+        # queued 0.6s, backfill has aged past 10 levels and outranks fresh urgent work
+        time.sleep(0.6)
+        urgent = sched.submit_call('adde', 112, lambda: order.append('urgent'), priority=0)
+        gate.set()
+        urgent.result(5)
+        backfill.result(5)
+        self.assertEqual(order, ['backfill', 'urgent'])
+
+    def test_per_host_cap(self):
+        sched = Scheduler(per_host=2, caps={('slow', 112): 1})
+        lock = threading.Lock()
+        running, peak = dict(fast=0, slow=0), dict(fast=0, slow=0)
+
+        def call(host):
+            with lock:
+                running[host] += 1
+                peak[host] = max(peak[host], running[host])
+            time.sleep(0.02)
+            with lock:
+                running[host] -= 1
+        futures = [sched.submit_call(host, 112, lambda host=host: call(host)) for host in ('fast', 'slow') * 6]
+        for f in futures:
+            f.result(5)
+        sched.shutdown()
+        self.assertEqual(peak, dict(fast=2, slow=1))
+
+    def test_session(self):
+        from pyadde.adde import Session, TEST_REQ_STRING
+        from pyadde.pool import ConnectionPool
+        from pyadde.server import AddeServer, SyntheticSource
+        text = TEST_REQ_STRING.replace('X 480 640', 'X 10 20')
+        with AddeServer(SyntheticSource(), latency=0.05) as srv:
+            ses = Session('127.0.0.1', srv.port, 'RKG', 6999, '', pool=ConnectionPool())
+            sched = Scheduler(per_host=2)
+            futures = [sched.submit(ses, text, priority=k % 3) for k in range(6)]
+            self.assertEqual([(f.result(10).lines, f.result().elements) for f in futures], [(10, 20)] * 6)
+            sched.shutdown()
+        stats = sched.stats()[('127.0.0.1', srv.port)]
+        self.assertEqual((stats['completed'], stats['cap']), (6, 2))
+        # at most two had left the queue when the last was submitted
+        self.assertGreaterEqual(stats['max_depth'], 4)
+
+    def test_async(self):
+        from pyadde.adde import TEST_REQ_STRING
+        from pyadde.aio import AsyncSession
+        from pyadde.server import AddeServer, SyntheticSource
+        text = TEST_REQ_STRING.replace('X 480 640', 'X 10 20')
+        asched = AsyncScheduler(per_host=1)
+
+        async def hold():
+            await asyncio.sleep(1.0)
+
+        async def fetch_all(ses):
+            zults = await asyncio.gather(*[asched.aget(ses, text, priority=k) for k in range(5)])
+            # a request stuck behind a long one fails at its deadline
+            blocker = asyncio.ensure_future(asched.run('adde', 112, hold))
+            await asyncio.sleep(0)
+            start = time.time()
+            with self.assertRaises(DeadlineExceeded):
+                await asched.run('adde', 112, hold, deadline=0.1)
+            waited = time.time() - start
+            blocker.cancel()
+            return zults, waited
+
+        with AddeServer(SyntheticSource(), latency=0.02) as srv:
+            ses = AsyncSession('127.0.0.1', srv.port, 'RKG', 6999, '')
+            zults, waited = asyncio.run(fetch_all(ses))
+        self.assertEqual([(z.lines, z.elements) for z in zults], [(10, 20)] * 5)
+        self.assertLess(waited, 0.5)
+        stats = asched.stats()[('127.0.0.1', srv.port)]
+        self.assertEqual((stats['completed'], stats['running'], stats['depth'], stats['max_depth']), (5, 0, 0, 4))
+        self.assertEqual(asched.stats()[('adde', 112)]['expired'], 1)
@@ -0,0 +1,471 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""server.py
+
+Local stand-in ADDE server, for exercising and benchmarking the client's socket path offline.
+
+Understands the adde_aget_t request layout built by adde.form_aget, including request text
+following the fixed structure, and answers AGET and ADIR requests from a payload source:
+a synthetic image generated to order, or an AREA file from disk. Replies can be delayed and
+throttled to imitate a distant server, and are gzip-compressed when the client asks.
+Like most ADDE servers, it closes each connection after replying.
+
+e.g.
+    with AddeServer(SyntheticSource(bytes_per_element=2), latency=0.05, bandwidth=10e6) as srv:
+        zult = Session('127.0.0.1', srv.port, 'RKG', 6999, '').aget(TEST_REQ_STRING)
+
+Copyright (c) 2014 University of Wisconsin SSEC. All rights reserved.
+"""
+
+import ctypes as C
+import logging
+import socketserver
+import struct
+import sys
+import threading
+import time
+import unittest
+import zlib
+
+import numpy as np
+
+from pyadde.adde import (CARD_SIZE, COMPRESSION_PORT_WORDS, adde_aget_t, adde_header_t, aget_placement, parse_request_text,
+                         native_to_payload, _image_dtype)
+
+LOG = logging.getLogger(__name__)
+
+# largest single send while shaping bandwidth
+SEND_CHUNK = 1 << 16
+
+# uncompressed bytes handed to the compressor at a time
+COMPRESS_CHUNK = 1 << 20
+
+# synthetic pixel values cycle with these periods, keeping them positive for each element size
+PATTERN_MODULUS = {1: 127, 2: 32749, 4: 2147483647}
+
+
+def read_request(sock):
+    """
+    receive one request from a client socket
+    :return: (adde_aget_t, request text as str), or None if the client closed without sending one
+    """
+    fixed = bytearray(C.sizeof(adde_aget_t))
+    first = sock.recv_into(fixed)
+    if first == 0:
+        # e.g. a connection pre-warmed by a client pool and never used
+        return None
+    _recv_exactly(sock, memoryview(fixed)[first:])
+    req = adde_aget_t.from_buffer(fixed)
+    if req.input_length > 0:
+        # long request text follows the fixed structure
+        extra = bytearray(req.input_length)
+        _recv_exactly(sock, extra)
+        text = bytes(extra)
+    else:
+        text = req.text
+    return req, text.decode('ascii', 'replace').strip()
+
+
+def _recv_exactly(sock, buf):
+    view = memoryview(buf)
+    while len(view):
+        n = sock.recv_into(view)
+        if n == 0:
+            raise IOError('client closed the connection mid-request')
+        view = view[n:]
+
+
+def gzip_parts(parts, level=6):
+    "gzip-compress a reply made of parts, yielding the compressed stream a chunk at a time"
+    deflater = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for part in parts:
+        view = memoryview(part)
+        for start in range(0, len(view), COMPRESS_CHUNK):
+            out = deflater.compress(view[start:start + COMPRESS_CHUNK])
+            if out:
+                yield out
+    yield deflater.flush()
+
+
+def pixel_value(line, element, band, bytes_per_element):
+    "value of a synthetic pixel at an image line and element, so clients can check what they received"
+    return (3 * np.asarray(line) + np.asarray(element) + 17 * band) % PATTERN_MODULUS[bytes_per_element]
+
+
+def _band_maps(bands):
+    bits = 0
+    for b in bands:
+        bits |= 1 << (b - 1)
+    low, high = bits & 0xffffffff, bits >> 32
+    # the header words are signed
+    return struct.unpack('!2i', struct.pack('!2I', low, high))
+
+
+def synthetic_area(lines=480, elements=640, bands=(1, ), bytes_per_element=2, nav=True, cal=False, comments=1,
+                   line_ul=1, element_ul=1, line_res=1, element_res=1, hhmmss=120000, area_number=1,
+                   prefix=(0, 0, 0), validity_code=0):
+    """
+    build a synthetic AGET payload in network order, pixels given by pixel_value()
+    multiple bands are interleaved by pixel, as ADDE sends them
+    :param nav: include a RECT nav block
+    :param cal: include a RAW cal block
+    :param comments: number of comment cards
+    :param prefix: lengths of the doc, cal and band sections of a line prefix; the doc section is filled
+        with the low byte of the image line number, the band section with the band numbers
+    :param validity_code: nonzero to lead each line prefix with this validity code
+    :return: bytearray payload, everything following the length word
+    """
+    h = adde_header_t()
+    h.relative_position_within_dataset = area_number
+    h.image_type = 4
+    h.sensor_source_number = 70
+    h.yyyddd = h.file_yyyddd = h.image_yyyddd = 2014164
+    h.hhmmss = h.file_hhmmss = h.image_hhmmss_or_ms = hhmmss
+    h.line_ul, h.element_ul = line_ul, element_ul
+    h.lines, h.elements, h.bytes_per_element = lines, elements, bytes_per_element
+    h.line_res, h.element_res = line_res, element_res
+    h.spectral_band_count = len(bands)
+    h.spectral_band_map_1_32, h.spectral_band_map_33_64 = _band_maps(bands)
+    h.memo = b'pyadde synthetic image'
+    h.source_type = b'RECT'
+    h.cal_type = b'RAW'
+    offset = 256
+    blocks = bytearray()
+    if nav:
+        h.nav_block_offset = offset
+        # reference line and element at the upper left, 0.01 degree pixels from 50N 100W
+        block = b'RECT' + struct.pack('!6i', line_ul, 500000, element_ul, 1000000, 100 * line_res, 100 * element_res)
+        blocks += block.ljust(128 * 4, b'\0')
+        offset += 128 * 4
+    if cal:
+        h.cal_block_offset = offset
+        blocks += b'RAW '.ljust(128 * 4, b'\0')
+        offset += 128 * 4
+    h.data_block_offset = offset
+    h.comment_count = comments
+    h.prefix_doc_length, h.prefix_cal_length, h.prefix_band_length = prefix
+    h.validity_code = validity_code
+    h.line_prefix_length = sum(prefix) + (4 if validity_code else 0)
+
+    data = np.empty((lines, elements, len(bands)), dtype=_image_dtype(bytes_per_element, '>'))
+    image_elements = element_ul + element_res * np.arange(elements)[None, :, None]
+    step = max(1, (1 << 20) // max(1, elements * len(bands)))
+    # a block of lines at a time, keeping the int64 intermediates small for full-disk images
+    for first in range(0, lines, step):
+        image_lines = line_ul + line_res * np.arange(first, min(lines, first + step))[:, None, None]
+        data[first:first + step] = pixel_value(image_lines, image_elements, np.asarray(bands)[None, None, :],
+                                               bytes_per_element)
+    if h.line_prefix_length:
+        data = _with_line_prefixes(data, h, bands)
+    cards = b''.join(('PYADDE SYNTHETIC IMAGE %d COMMENT %d' % (area_number, k)).ljust(CARD_SIZE).encode('ascii')
+                     for k in range(comments))
+    return bytearray(h) + blocks + data.tobytes() + cards
+
+
+def _with_line_prefixes(data, h, bands):
+    "image lines as bytes, each led by a synthetic line prefix laid out per the header"
+    out = np.zeros((h.lines, h.line_prefix_length + data[0].nbytes), dtype=np.uint8)
+    out[:, h.line_prefix_length:] = data.reshape(h.lines, -1).view(np.uint8)
+    offset = 0
+    if h.validity_code:
+        out[:, :4] = np.frombuffer(struct.pack('!i', h.validity_code), dtype=np.uint8)
+        offset = 4
+    image_lines = h.line_ul + h.line_res * np.arange(h.lines)
+    out[:, offset:offset + h.prefix_doc_length] = (image_lines % 256)[:, None]
+    offset += h.prefix_doc_length + h.prefix_cal_length
+    band_bytes = bytes(bytearray(bands))[:h.prefix_band_length].ljust(h.prefix_band_length, b'\0')
+    out[:, offset:offset + h.prefix_band_length] = np.frombuffer(band_bytes, dtype=np.uint8)
+    return out
+
+
+class SyntheticSource(object):
+    """
+    payload source generating synthetic images to order
+
+    AGET requests in image coordinates (IU, IC) get the sector they name; other placements are
+    treated as image coordinates too. The requested lines and elements are honored, and so is BAND=
+    unless it is ALL. ADIR requests list `images` synthetic images, one minute apart.
+    """
+
+    def __init__(self, lines=480, elements=640, bands=(1, ), bytes_per_element=2, nav=True, cal=False, comments=1,
+                 images=10, prefix=(0, 0, 0), validity_code=0, hhmmss=120000):
+        """
+        :param lines, elements: image size when a request does not give one
+        :param hhmmss: image time of AGET replies, which may be changed between requests
+        :param bands: band numbers served when a request does not select some
+        :param prefix, validity_code: line prefix layout, see synthetic_area
+        """
+        self.lines = lines
+        self.elements = elements
+        self.bands = tuple(bands)
+        self.bytes_per_element = bytes_per_element
+        self.nav = nav
+        self.cal = cal
+        self.comments = comments
+        self.images = images
+        self.prefix = tuple(prefix)
+        self.validity_code = validity_code
+        self.hhmmss = hhmmss
+        # the last payload built, reused while requests keep asking for the same layout
+        self._last = (None, None)
+
+    def _layout(self, text):
+        lines, elements, line_ul, element_ul = self.lines, self.elements, 1, 1
+        try:
+            coord_type, c1, c2, lines, elements = aget_placement(text)
+            line_ul, element_ul = int(c1), int(c2)
+            if coord_type[1] == 'C':
+                line_ul -= lines // 2
+                element_ul -= elements // 2
+        except ValueError:
+            pass
+        _, keywords = parse_request_text(text)
+        bands = self.bands
+        requested = keywords.get('BAND', '').split()
+        if requested and requested[0].upper() != 'ALL':
+            bands = tuple(int(b) for b in requested)
+        return dict(lines=lines, elements=elements, line_ul=line_ul, element_ul=element_ul, bands=bands)
+
+    def aget(self, text):
+        "payload for AGET request text"
+        layout = self._layout(text)
+        layout['hhmmss'] = self.hhmmss
+        key, payload = self._last
+        if key != layout:
+            payload = synthetic_area(bytes_per_element=self.bytes_per_element, nav=self.nav, cal=self.cal,
+                                     comments=self.comments, prefix=self.prefix, validity_code=self.validity_code,
+                                     **layout)
+            self._last = (layout, payload)
+        return payload
+
+    def adir(self, text):
+        "list of directory entries for ADIR request text, each the area number, header and comment cards"
+        entries = []
+        for k in range(self.images):
+            # a one-pixel image stands in for the header, which is then given the full size
+            payload = synthetic_area(lines=1, elements=1, bands=self.bands, bytes_per_element=self.bytes_per_element,
+                                     nav=False, comments=self.comments, hhmmss=120000 + 100 * k, area_number=k + 1)
+            h = adde_header_t.from_buffer(payload)
+            h.lines, h.elements = self.lines, self.elements
+            del h
+            cards = payload[len(payload) - self.comments * CARD_SIZE:]
+            entries.append(struct.pack('!i', k + 1) + bytes(payload[:256]) + bytes(cards))
+        return entries
+
+
+class FileSource(object):
+    """
+    payload source serving one AREA file from disk for every request, whatever it asks for
+    native-order files are converted to network order once, on loading
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as fp:
+            payload = bytearray(fp.read())
+        if adde_header_t.from_buffer(payload).image_type != 4:
+            native_to_payload(payload)
+        self.payload = payload
+
+    def aget(self, text):
+        return self.payload
+
+    def adir(self, text):
+        h = adde_header_t.from_buffer(self.payload)
+        cards = self.payload[len(self.payload) - h.comment_count * CARD_SIZE:]
+        return [struct.pack('!i', max(h.relative_position_within_dataset, 1)) + bytes(self.payload[:256]) +
+                bytes(cards)]
+
+
+class _Handler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        srv = self.server.adde
+        try:
+            request = read_request(self.request)
+        except IOError as err:
+            LOG.warning('bad request: %s' % err)
+            return
+        if request is None:
+            return
+        req, text = request
+        service = req.service.decode('ascii', 'replace').strip()
+        LOG.debug('%s %s' % (service, text))
+        if req.preamble.port not in COMPRESSION_PORT_WORDS.values():
+            LOG.warning('reply compression %d is not supported, closing' % req.preamble.port)
+            return
+        if srv.latency:
+            time.sleep(srv.latency)
+        if service == 'ADIR':
+            reply = bytearray()
+            for entry in srv.source.adir(text):
+                reply += struct.pack('!l', len(entry)) + entry
+            parts = (reply, struct.pack('!l', 0))
+        else:
+            payload = srv.source.aget(text)
+            parts = (struct.pack('!l', len(payload)), payload)
+        if req.preamble.port == COMPRESSION_PORT_WORDS['gzip']:
+            parts = gzip_parts(parts)
+        srv.send(self.request, parts)
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class AddeServer(object):
+    """
+    threaded ADDE server on a local port, answering AGET and ADIR requests from source
+
+    latency seconds pass between receiving a request and the first byte of the reply;
+    with bandwidth set, each reply is paced to that many bytes per second.
+    To imitate dropped connections, the next `drops` replies are cut off after drop_after bytes.
+    """
+    source = None
+    latency = None
+    bandwidth = None
+    drop_after = None
+    drops = 0
+    requests = 0
+    bytes_sent = 0
+
+    def __init__(self, source=None, host='127.0.0.1', port=0, latency=0.0, bandwidth=None, drop_after=None, drops=0):
+        """
+        :param source: SyntheticSource, FileSource or similar; default is a SyntheticSource
+        :param port: port to listen on, 0 for any free one; see the port attribute
+        """
+        self.source = source if (source is not None) else SyntheticSource()
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.drop_after = drop_after
+        self.drops = drops
+        self._lock = threading.Lock()
+        self._sent = threading.Condition(self._lock)
+        self._server = _TCPServer((host, port), _Handler)
+        self._server.adde = self
+        self._thread = None
+
+    @property
+    def host(self):
+        return self._server.server_address[0]
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def send(self, sock, parts):
+        "send a reply made of a sequence of parts, paced to the bandwidth limit"
+        start = time.time()
+        sent = 0
+        limit = None
+        with self._lock:
+            if self.drops > 0 and self.drop_after is not None:
+                self.drops -= 1
+                limit = self.drop_after
+        for part in parts:
+            view = memoryview(part)
+            if limit is not None:
+                view = view[:max(0, limit - sent)]
+                if not len(view):
+                    LOG.info('dropping the connection after %d bytes' % sent)
+                    break
+            if not self.bandwidth:
+                sock.sendall(view)
+                sent += len(view)
+                continue
+            done = 0
+            while done < len(view):
+                done += sock.send(view[done:done + SEND_CHUNK])
+                ahead = start + (sent + done) / float(self.bandwidth) - time.time()
+                if ahead > 0:
+                    time.sleep(ahead)
+            sent += done
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += sent
+            self._sent.notify_all()
+
+    def start(self):
+        "serve from a background thread and return self"
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def wait(self, requests, timeout=5.0):
+        """
+        wait until at least `requests` replies have been sent in full, or cut off, and return the count
+        a client may finish reading a reply before the server has counted it
+        """
+        with self._sent:
+            self._sent.wait_for(lambda: self.requests >= requests, timeout)
+            return self.requests
+
+    def stats(self):
+        with self._lock:
+            return dict(requests=self.requests, bytes_sent=self.bytes_sent)
+
+
+class test_server(unittest.TestCase):
+
+    def test_aget(self):
+        from pyadde.adde import Session, TEST_REQ_STRING
+        from pyadde.pool import ConnectionPool
+        with AddeServer(SyntheticSource(bytes_per_element=4, comments=2)) as srv:
+            ses = Session('127.0.0.1', srv.port, 'RKG', 6999, '', pool=ConnectionPool())
+            zult = ses.aget(TEST_REQ_STRING.replace('EC 45 90', 'IU 100 200'))
+            self.assertEqual((zult.lines, zult.elements, zult.comment_count), (480, 640, 2))
+            expected = pixel_value(100 + np.arange(480)[:, None], 200 + np.arange(640)[None, :], 1, 4)
+            np.testing.assert_array_equal(zult.image_array, expected)
+            self.assertEqual(bytes(zult._nav_raw[:4]), b'RECT')
+            rows = ses.adir('EASTL FD ALL')
+            self.assertEqual(len(rows), 10)
+            self.assertEqual(list(rows['hhmmss'][:2]), [120000, 120100])
+            self.assertEqual(srv.wait(2), 2)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Serve synthetic or on-disk AREA payloads as a local ADDE server.")
+    parser.add_argument('-p', '--port', type=int, default=8112, help='port to listen on')
+    parser.add_argument('--area', help='serve this AREA file instead of synthetic images')
+    parser.add_argument('--lines', type=int, default=480)
+    parser.add_argument('--elements', type=int, default=640)
+    parser.add_argument('--bands', type=int, nargs='+', default=[1])
+    parser.add_argument('--bpe', type=int, default=2, choices=(1, 2, 4), help='bytes per element')
+    parser.add_argument('--no-nav', dest='nav', action='store_false', default=True)
+    parser.add_argument('--cal', action='store_true', default=False)
+    parser.add_argument('--comments', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before each reply')
+    parser.add_argument('--bandwidth', type=float, default=None, help='bytes per second for each reply')
+    parser.add_argument('-v', '--verbose', dest='verbosity', action="count", default=0,
+                        help='each occurrence increases verbosity 1 level through ERROR-WARNING-INFO-DEBUG')
+    args = parser.parse_args()
+    levels = [logging.ERROR, logging.WARN, logging.INFO, logging.DEBUG]
+    logging.basicConfig(level=levels[min(3, args.verbosity)])
+
+    if args.area:
+        source = FileSource(args.area)
+    else:
+        source = SyntheticSource(args.lines, args.elements, args.bands, args.bpe, args.nav, args.cal, args.comments)
+    srv = AddeServer(source, host='', port=args.port, latency=args.latency, bandwidth=args.bandwidth)
+    LOG.info('serving on port %d' % srv.port)
+    try:
+        srv._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())